@@ -0,0 +1,198 @@
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from elastic.elastic_settings import ElasticSettings
+from elastic.management.loaders.loader import Loader
+from elastic.search import Search
+
+
+logger = logging.getLogger(__name__)
+
+
+class BulkEncoder():
+    ''' Streaming encoder for elastic bulk index requests. Documents are encoded straight in to a reusable byte
+    buffer which is handed to flush_fun when adding the next document would take it over max_bytes. The number
+    of bytes and documents sent in each flush is recorded in flushes. '''
+
+    def __init__(self, idx, idx_type, flush_fun=None, max_bytes=5242880, max_docs=None):
+        '''
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type
+        @type  flush_fun: function
+        @keyword flush_fun: function called with the bulk payload (bytes) and number of documents
+                            (default: L{Loader.bulk_load})
+        @type  max_bytes: int
+        @keyword max_bytes: maximum size of a bulk payload in bytes
+        @type  max_docs: int
+        @keyword max_docs: maximum number of documents in a bulk payload (default: no limit)
+        '''
+        self.idx = idx
+        self.idx_type = idx_type
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        if flush_fun is None:
+            loader = Loader()
+            flush_fun = (lambda payload, ndocs: loader.bulk_load(idx, idx_type, payload))
+        self.flush_fun = flush_fun
+        self.buffer = bytearray()
+        self.ndocs = 0
+        self.flushes = []
+
+    def add(self, doc_id, doc):
+        ''' Add a document to be indexed with the given id. '''
+        self.add_encoded(doc_id, json.dumps(doc).encode('utf-8'))
+
+    def add_encoded(self, doc_id, doc_line):
+        ''' Add a document already encoded as a line of json (bytes) to be indexed with the given id. '''
+        action = {"index": {"_index": self.idx, "_type": self.idx_type, "_id": doc_id}}
+        lines = json.dumps(action).encode('utf-8') + b'\n' + doc_line + b'\n'
+
+        if self.ndocs > 0 and (len(self.buffer) + len(lines) > self.max_bytes or
+                               (self.max_docs is not None and self.ndocs >= self.max_docs)):
+            self.flush()
+        if len(lines) > self.max_bytes:
+            logger.warning(str(doc_id) + ' is ' + str(len(lines)) + ' bytes, over the bulk limit')
+
+        self.buffer += lines
+        self.ndocs += 1
+
+    def flush(self):
+        ''' Send the buffered documents and empty the buffer. '''
+        if self.ndocs == 0:
+            return
+        self.flush_fun(bytes(self.buffer), self.ndocs)
+        self.flushes.append((len(self.buffer), self.ndocs))
+        logger.debug(self.idx_type + ' bulk flush: ' + str(len(self.buffer)) + ' bytes, ' +
+                     str(self.ndocs) + ' docs')
+        print('.', end="", flush=True)
+        del self.buffer[:]
+        self.ndocs = 0
+
+    def close(self):
+        ''' Flush any remaining documents and log the totals. '''
+        self.flush()
+        logger.warning(self.idx_type + ' bulk loaded ' + str(sum(ndocs for _nbytes, ndocs in self.flushes)) +
+                       ' docs (' + str(sum(nbytes for nbytes, _ndocs in self.flushes)) + ' bytes) in ' +
+                       str(len(self.flushes)) + ' requests')
+
+
+class BulkLoader():
+    ''' Loader stage sending bulk payloads from a bounded queue with a pool of threads, so that several bulk
+    requests are in flight while the next payload is encoded. Requests go through L{Search.elastic_request}, as
+    the other requests to elastic do. submit blocks when queue_size payloads are waiting, which keeps the memory
+    used bounded. Items rejected by elastic (status 429, e.g. a full bulk thread pool queue) are retried
+    individually with a backoff. '''
+
+    REJECTED_STATUS = 429
+
+    def __init__(self, idx, idx_type, workers=2, queue_size=4, max_retries=5, url=None):
+        '''
+        @type  idx: string
+        @param idx: name of the index
+        @type  idx_type: string
+        @param idx_type: name of the idx type
+        @type  workers: int
+        @keyword workers: number of threads sending bulk requests, with 0 the payloads are sent by submit
+        @type  queue_size: int
+        @keyword queue_size: maximum number of payloads waiting to be sent
+        @type  max_retries: int
+        @keyword max_retries: number of times a rejected item is retried
+        @type  url: string
+        @keyword url: elastic url (default: L{ElasticSettings.url})
+        '''
+        if url is None:
+            url = ElasticSettings.url()
+        self.url = url
+        self.bulk_path = idx + '/' + idx_type + '/_bulk'
+        self.idx_type = idx_type
+        self.max_retries = max_retries
+        self.failed = []
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, payload, ndocs=None):
+        ''' Queue a bulk payload (bytes) to be sent, blocking while the queue is full. '''
+        if len(self.threads) == 0:
+            self._send(payload)
+        else:
+            self.queue.put(payload)
+
+    def close(self):
+        ''' Wait for the queued payloads to be sent and stop the threads. When called from a finally clause
+        while an exception is in flight the failed items are only logged, so that exception is not masked.
+        @raise RuntimeError: if any items failed to load '''
+        for _thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if len(self.failed) > 0:
+            logger.critical(self.idx_type + ' ' + str(len(self.failed)) + ' items failed to load, e.g. ' +
+                            str(self.failed[0]))
+            if sys.exc_info()[0] is None:
+                raise RuntimeError(self.idx_type + ': ' + str(len(self.failed)) + ' items failed to bulk load')
+
+    def _run(self):
+        while True:
+            payload = self.queue.get()
+            if payload is None:
+                return
+            try:
+                self._send(payload)
+            except Exception as e:
+                logger.exception('Bulk request failed')
+                self._failed(repr(e))
+
+    def _failed(self, error):
+        with self.lock:
+            self.failed.append(error)
+
+    def _post(self, payload):
+        ''' Post the payload, retrying the whole request while elastic rejects it. '''
+        for attempt in range(self.max_retries + 1):
+            resp = Search.elastic_request(self.url, self.bulk_path, data=payload)
+            if resp.status_code != self.REJECTED_STATUS:
+                return resp
+            time.sleep(0.5 * 2 ** attempt)
+        return resp
+
+    def _send(self, payload):
+        resp = self._post(payload)
+        if resp.status_code != 200:
+            self._failed(str(resp.status_code) + ' ' + resp.content.decode("utf-8")[:200])
+            return
+
+        resp_json = resp.json()
+        if not resp_json.get('errors'):
+            return
+
+        lines = payload.split(b'\n')
+        for i, item in enumerate(resp_json['items']):
+            result = list(item.values())[0]
+            if result.get('status', 200) < 300:
+                continue
+            item_payload = lines[2 * i] + b'\n' + lines[2 * i + 1] + b'\n'
+            if result['status'] == self.REJECTED_STATUS:
+                self._retry_item(item_payload, result)
+            else:
+                self._failed(result)
+
+    def _retry_item(self, item_payload, result):
+        ''' Resend a single rejected item. '''
+        for attempt in range(self.max_retries):
+            time.sleep(0.5 * 2 ** attempt)
+            resp = Search.elastic_request(self.url, self.bulk_path, data=item_payload)
+            if resp.status_code == 200:
+                result = list(resp.json()['items'][0].values())[0]
+                if result.get('status', 200) < 300:
+                    return
+                if result['status'] != self.REJECTED_STATUS:
+                    break
+        self._failed(result)
@@ -1,5 +1,12 @@
+import collections
+import copy
+import datetime
 import json
 import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from criteria.helper.criteria_manager import CriteriaManager
 from data_pipeline.utils import IniParser
@@ -12,11 +19,54 @@ from elastic.search import Search, ElasticQuery, ScanAndScroll, Highlight
 from elastic.utils import ElasticUtils
 from disease.utils import Disease
 from region.utils import Region
+from criteria.helper.result_container import SpillingResultContainer, CriteriaList, ColumnarResultContainer
+from criteria.helper.bulk import BulkEncoder, BulkLoader
+from criteria.helper.data_loader import DataLoader
 import re
+import requests
 
 
 logger = logging.getLogger(__name__)
 
+# build ids (see Criteria.get_build_meta) and the build times recorded in the _meta of a criteria
+BUILD_ID_FORMAT = '%Y%m%d%H%M%S'
+BUILD_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def first_author(study_doc):
+    ''' First author ('name initials') of a study doc. '''
+    author = getattr(study_doc, 'authors')[0]
+    return author['name'] + ' ' + author['initials']
+
+
+class SourceFieldsWatcher(dict):
+    ''' _source of a hit (debug_source_fields mode) logging a warning the first time a field that is not in the
+    declared fields is read. '''
+
+    warned = set()
+
+    def __init__(self, source, declared, section):
+        super().__init__(source)
+        self.declared = declared
+        self.section = section
+
+    def _check(self, field):
+        if field not in self.declared and (self.section, field) not in SourceFieldsWatcher.warned:
+            SourceFieldsWatcher.warned.add((self.section, field))
+            logger.warning(self.section + ' reads _source field ' + str(field) + ' not in its SOURCE_FIELDS')
+
+    def __getitem__(self, field):
+        self._check(field)
+        return super().__getitem__(field)
+
+    def get(self, field, default=None):
+        self._check(field)
+        return super().get(field, default)
+
+    def __contains__(self, field):
+        self._check(field)
+        return super().__contains__(field)
+
 
 class Criteria():
     ''' Criteria class implementing common functions for all criteria types  '''
@@ -29,8 +79,26 @@ class Criteria():
     global hit_counter
     hit_counter = 0
 
+    # _source fields read by the criteria of a sub_class, by section (see get_source_fields)
+    SOURCE_FIELDS = {}
+
+    # first authors of studies, by dil_study_id
+    study_authors = DataLoader('STUDY', 'STUDY', sources=['authors'], value_fun=first_author)
+
     @classmethod
-    def process_criteria(cls, feature, section, config, sub_class, test=False):
+    def close_connections(cls):
+        ''' Close the connections kept for the run by a sub class, called when a build of a criteria is done. '''
+        pass
+
+    @classmethod
+    def clear_caches(cls):
+        ''' Forget the documents and index metadata kept for the run, called when a build of a criteria is done
+        so that a long running process (e.g. a django worker) does not use them in its next build. Sub classes
+        keeping their own caches extend this. '''
+        DataLoader.clear_all()
+
+    @classmethod
+    def process_criteria(cls, feature, section, config, sub_class, test=False, slices=None, pipeline_workers=None):
         ''' Top level function that calls the right criteria implementation based on the subclass passed. Iterates over all the
             documents using the ScanAndScroll and the hits are processed by the inner function process_hits.
             The entire result is stored in result_container (a dict), and at the end of the processing, the result is
@@ -43,9 +111,14 @@ class Criteria():
         @keyword config: The config object initialized from criteria.ini.
         @type  sub_class: string
         @param sub_class: The name of the inherited sub_class where the actual implementation is
+        @type  slices: int
+        @keyword slices: number of worker processes to process the scroll pages in (default: slices in the
+                         criteria.ini section or 1)
+        @type  pipeline_workers: int
+        @keyword pipeline_workers: number of threads to run the handlers in while the scroll continues (default:
+                                   pipeline_workers in the criteria.ini section or 0, i.e. no pipeline)
         '''
         global gl_result_container
-        gl_result_container = {}
         test_mode = test
         if config is None:
             if test_mode:
@@ -53,41 +126,37 @@ class Criteria():
             else:
                 config = CriteriaManager().get_criteria_config(ini_file='criteria.ini')
 
+        build_meta = cls.get_build_meta()
+        gl_result_container = cls.new_result_container(section, config)
         section_config = config[section]
-        source_idx = section_config['source_idx']
-
-        if ',' in source_idx:
-            idxs = source_idx.split(',')
-            idx_all = [ElasticSettings.idx(idx) for idx in idxs]
-            source_idx = ','.join(idx_all)
-        else:
-            source_idx = ElasticSettings.idx(section_config['source_idx'])
-
-        source_idx_type = None
-        if 'source_idx_type' in section_config:
-            source_idx_type = section_config['source_idx_type']
-
-        if source_idx_type is not None:
-            source_idx = ElasticSettings.idx(section_config['source_idx'], idx_type=section_config['source_idx_type'])
-        else:
-            source_idx_type = ''
+        if slices is None:
+            slices = int(section_config.get('slices', 1))
+        if pipeline_workers is None:
+            pipeline_workers = int(section_config.get('pipeline_workers', 0))
 
+        (source_idx, source_idx_type) = cls.get_source_idx(section, config)
         logger.warning(source_idx + ' ' + source_idx_type)
 
+        watch_source_fields = cls.get_source_watcher(section, config)
+        process_page = sub_class.get_page_handler(section)
+
         def process_hits(resp_json):
             global gl_result_container
             hits = resp_json['hits']['hits']
             global hit_counter
-            for hit in hits:
-                hit_counter = hit_counter + 1
-
-                result_container = sub_class.tag_feature_to_disease(hit, section, config,
-                                                                    result_container=gl_result_container)
-                gl_result_container = result_container
+            if watch_source_fields is not None:
+                hits = [watch_source_fields(hit) for hit in hits]
+            hit_counter = hit_counter + len(hits)
 
-                if test_mode:
+            if test_mode:
+                # a hit at a time, until there are enough results
+                for hit in hits:
+                    gl_result_container = process_page([hit], section, config, gl_result_container)
                     if gl_result_container is not None and len(gl_result_container) > 5:
                         return
+            else:
+                gl_result_container = process_page(hits, section, config, gl_result_container)
+            cls.check_result_container(gl_result_container)
 
         query = cls.get_elastic_query(section, config)
 
@@ -117,10 +186,453 @@ class Criteria():
                 process_hits(response.json())
                 if gl_result_container is not None:
                     result_size = len(gl_result_container)
+        elif section_config.get('all_diseases', 'false').lower() == 'true':
+            cls.stream_all_diseases(feature, section, config, source_idx, query, build_meta=build_meta)
+            return
+        elif slices > 1:
+            if pipeline_workers > 0:
+                logger.warning(section + ' has slices and pipeline_workers, processing in ' + str(slices) +
+                               ' slices without a pipeline')
+            gl_result_container = cls.scan_in_slices(source_idx, query, section, config, sub_class, slices)
+        elif pipeline_workers > 0:
+            gl_result_container = cls.scan_pipelined(source_idx, query, section, config, sub_class, pipeline_workers,
+                                                     queue_size=int(section_config.get('pipeline_queue_size', 4)))
         else:
             ScanAndScroll.scan_and_scroll(source_idx, call_fun=process_hits, query=query)
 
-        cls.map_and_load(feature, section, config, gl_result_container)
+        cls.map_and_load(feature, section, config, gl_result_container, build_meta=build_meta)
+
+    @classmethod
+    def stream_all_diseases(cls, feature, section, config, source_idx, query, build_meta=None):
+        ''' Fast path for criterias tagging every feature to all the diseases (eg. the MHC criterias). The
+            document (as built by L{tag_feature_to_all_diseases}) and its score are the same for every feature
+            apart from the qid, so it is encoded once and a bulk line is written for each hit straight from the
+            scroll, without a result container. The feature id is the hit _id or the _source field given by
+            feature_id_field in the section.
+        '''
+        section_config = config[section]
+        feature_id_field = section_config.get('feature_id_field', '_id')
+
+        (criteria_idx, criteria_idx_type) = (cls.get_criteria_idx(feature, config), section)
+        cls.create_criteria_mapping(criteria_idx, criteria_idx_type, build_meta=build_meta)
+
+        template = cls.tag_feature_to_all_diseases('', section, config, {})['']
+        disease_tags = list(template.keys())
+        template['score'] = cls.calculate_score(disease_tags)
+        template['disease_tags'] = disease_tags
+        template_prefix = json.dumps(template)[:-1].encode('utf-8') + b', "qid": '
+
+        bulk_options = cls.get_bulk_options(section, config)
+        loader = BulkLoader(criteria_idx, criteria_idx_type, workers=bulk_options['workers'],
+                            queue_size=bulk_options['queue_size'])
+        encoder = BulkEncoder(criteria_idx, criteria_idx_type, flush_fun=loader.submit,
+                              max_bytes=bulk_options['max_bytes'])
+
+        def process_hits(resp_json):
+            for hit in resp_json['hits']['hits']:
+                if feature_id_field == '_id':
+                    feature_id = hit['_id']
+                else:
+                    feature_id = hit['_source'][feature_id_field]
+                encoder.add_encoded(feature_id, template_prefix + json.dumps(feature_id).encode('utf-8') + b'}')
+
+        bulk_settings = cls.start_bulk_mode(criteria_idx, feature, config)
+        try:
+            ScanAndScroll.scan_and_scroll(source_idx, call_fun=process_hits, query=query)
+            encoder.close()
+        finally:
+            try:
+                loader.close()
+            finally:
+                cls.end_bulk_mode(criteria_idx, bulk_settings)
+        logger.warning(criteria_idx + ' ' + criteria_idx_type + ' loaded successfully. DONE')
+
+    @classmethod
+    def process_criteria_group(cls, feature, sections, config, sub_class):
+        ''' Builds several criterias that read the same source index with a single scroll. Every page of hits is
+            fed to the handler of each section, each with its own result container, and each result is loaded
+            in to its own index type.
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  sections: list
+        @keyword sections: The sections in the criteria.ini file sharing a source index (see L{group_by_source})
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @type  sub_class: string
+        @param sub_class: The name of the inherited sub_class where the actual implementation is
+        '''
+        build_meta = cls.get_build_meta()
+        result_containers = {section: cls.new_result_container(section, config) for section in sections}
+        (source_idx, source_idx_type) = cls.get_source_idx(sections[0], config)
+        logger.warning(source_idx + ' ' + source_idx_type + ' shared by ' + ','.join(sections))
+        last_section = sections[-1]
+        source_watchers = {section: cls.get_source_watcher(section, config) for section in sections}
+        page_handlers = {section: sub_class.get_page_handler(section) for section in sections}
+
+        def process_hits(resp_json):
+            hits = resp_json['hits']['hits']
+            global hit_counter
+            hit_counter = hit_counter + len(hits)
+            for section in sections:
+                # handlers may add to or replace the fields of a hit (not change them in place), so all but
+                # the last get their own shallow copy of each hit and its _source
+                section_hits = hits if section == last_section else \
+                    [dict(hit, _source=dict(hit.get('_source', {}))) for hit in hits]
+                if source_watchers[section] is not None:
+                    section_hits = [source_watchers[section](hit) for hit in section_hits]
+                result_containers[section] = page_handlers[section](section_hits, section, config,
+                                                                    result_containers[section])
+                cls.check_result_container(result_containers[section])
+
+        query = cls.get_shared_query(sections, config)
+        ScanAndScroll.scan_and_scroll(source_idx, call_fun=process_hits, query=query)
+
+        for section in sections:
+            cls.map_and_load(feature, section, config, result_containers[section], build_meta=build_meta)
+
+    @classmethod
+    def group_by_source(cls, sections, config):
+        ''' function to group criterias that can be built from a single scroll, i.e. those with the same
+            source index and the same query (ignoring the _source fields requested)
+        @type  sections: list
+        @keyword sections: The sections in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: list of lists of sections, in the order of first appearance
+        '''
+        groups = {}
+        for section in sections:
+            (source_idx, source_idx_type) = cls.get_source_idx(section, config)  # @UnusedVariable
+            query = cls.get_elastic_query(section, config)
+            if query is None:
+                query_body = {"query": Query.match_all().query}
+            else:
+                query_body = {k: v for k, v in query.query.items() if k != '_source'}
+            scan_key = (source_idx, json.dumps(query_body, sort_keys=True))
+            groups.setdefault(scan_key, []).append(section)
+        return list(groups.values())
+
+    @classmethod
+    def get_shared_query(cls, sections, config):
+        ''' function to build the query for a group of criterias sharing a scroll (see L{group_by_source}).
+            The _source fields are the union of those requested by each criteria.
+        '''
+        queries = [cls.get_elastic_query(section, config) for section in sections]
+        if any(query is None or '_source' not in query.query for query in queries):
+            return None if queries[0] is None else cls._without_sources(queries[0])
+
+        sources = []
+        for query in queries:
+            sources.extend([field for field in query.query['_source'] if field not in sources])
+        shared_query = copy.deepcopy(queries[0])
+        shared_query.query['_source'] = sources
+        return shared_query
+
+    @classmethod
+    def _without_sources(cls, query):
+        ''' Copy of the query returning the full documents. '''
+        query = copy.deepcopy(query)
+        query.query.pop('_source', None)
+        return query
+
+    @classmethod
+    def get_source_idx(cls, section, config):
+        ''' function to get the source index (or comma separated indexes) a criteria is built from
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: tuple of source_idx (including the idx type if given) and source_idx_type
+        '''
+        section_config = config[section]
+        source_idx = section_config['source_idx']
+
+        if ',' in source_idx:
+            idxs = source_idx.split(',')
+            idx_all = [ElasticSettings.idx(idx) for idx in idxs]
+            source_idx = ','.join(idx_all)
+        else:
+            source_idx = ElasticSettings.idx(section_config['source_idx'])
+
+        source_idx_type = None
+        if 'source_idx_type' in section_config:
+            source_idx_type = section_config['source_idx_type']
+
+        if source_idx_type is not None:
+            source_idx = ElasticSettings.idx(section_config['source_idx'], idx_type=section_config['source_idx_type'])
+        else:
+            source_idx_type = ''
+
+        return (source_idx, source_idx_type)
+
+    # how long (in seconds) scan_in_slices waits on a queue before checking its workers are alive
+    SLICE_POLL_SECS = 1
+
+    @classmethod
+    def scan_in_slices(cls, source_idx, query, section, config, sub_class, slices):
+        ''' function to process the source index in parallel. The index is scrolled once and the pages are dealt
+            round robin to slices worker processes, each building a partial result container. The partial
+            containers are merged when the scroll is done. In a daemonic process (e.g. a worker of the --workers
+            pool), which cannot start processes, the slices are threads.
+        @type  source_idx: string
+        @param source_idx: index (and idx type) to scroll
+        @type  query: L{ElasticQuery}
+        @param query: query to scroll with
+        @type  slices: int
+        @param slices: number of worker processes
+        @return: merged result container
+        '''
+        if multiprocessing.current_process().daemon:
+            (queue_class, worker_class) = (queue.Queue, threading.Thread)
+        else:
+            (queue_class, worker_class) = (multiprocessing.Queue, multiprocessing.Process)
+        page_queues = [queue_class(maxsize=4) for _i in range(slices)]
+        result_queue = queue_class()
+        in_process = worker_class is multiprocessing.Process
+        workers = [worker_class(target=process_slice,
+                                args=(sub_class, section, config, page_queue, result_queue, in_process),
+                                daemon=not in_process)
+                   for page_queue in page_queues]
+        for worker in workers:
+            worker.start()
+
+        def put_page(slice_idx, hits):
+            ''' Put a page on the queue of a slice, giving up if its worker has died. '''
+            while workers[slice_idx].is_alive():
+                try:
+                    page_queues[slice_idx].put(hits, timeout=cls.SLICE_POLL_SECS)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        page_counter = [0]
+
+        def deal_hits(resp_json):
+            if not put_page(page_counter[0] % slices, resp_json['hits']['hits']):
+                raise RuntimeError(section + ' slice worker ' + str(page_counter[0] % slices) + ' died')
+            page_counter[0] += 1
+
+        results = []
+        try:
+            try:
+                ScanAndScroll.scan_and_scroll(source_idx, call_fun=deal_hits, query=query)
+            finally:
+                for slice_idx in range(slices):
+                    put_page(slice_idx, None)
+        finally:
+            # a worker process does not exit until its partial container is read, so the results are collected
+            # (and the workers joined) even if the scroll failed
+            results = cls.collect_slices(result_queue, workers)
+
+        result_container = cls.new_result_container(section, config)
+        errors = [str(slices - len(results)) + ' slice workers died'] if len(results) < slices else []
+        for (success, partial_result) in results:
+            if not success:
+                errors.append(partial_result)
+            elif len(result_container) == 0 and len(getattr(result_container, 'run_files', [])) == 0:
+                result_container = partial_result
+            else:
+                result_container = cls.merge_result_containers(result_container, partial_result)
+
+        if len(errors) > 0:
+            raise RuntimeError(section + ' failed in slice worker: ' + '; '.join(errors))
+        return result_container
+
+    @classmethod
+    def collect_slices(cls, result_queue, workers):
+        ''' Get the (success, result container or error) of each slice worker of L{scan_in_slices} from
+            result_queue, until there is one for each worker or none of them is alive, then join the workers,
+            terminating any worker process still running. '''
+        results = []
+        while len(results) < len(workers):
+            try:
+                results.append(result_queue.get(timeout=cls.SLICE_POLL_SECS))
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    # the last results may have been put just before the workers exited
+                    try:
+                        while len(results) < len(workers):
+                            results.append(result_queue.get(timeout=cls.SLICE_POLL_SECS))
+                    except queue.Empty:
+                        pass
+                    break
+
+        for worker in workers:
+            worker.join(timeout=cls.SLICE_POLL_SECS * 10)
+            if worker.is_alive() and hasattr(worker, 'terminate'):
+                logger.warning('Terminating slice worker ' + str(worker.name))
+                worker.terminate()
+                worker.join()
+        return results
+
+    @classmethod
+    def scan_pipelined(cls, source_idx, query, section, config, sub_class, workers, queue_size=4):
+        ''' function to process the source index as a pipeline of threads, so that the waits on elastic (and Rserve)
+            overlap. The scroll runs in its own thread putting the pages on a queue of queue_size pages. Each page
+            is prefetched and run through the handlers by one of the workers threads, in to a container of its own.
+            The page containers are merged in to the result container by this (the only writing) thread, in the
+            order of the pages, with no more than queue_size pages being processed at a time. The result is then
+            loaded by L{map_and_load} as for the other scans.
+        @type  source_idx: string
+        @param source_idx: index (and idx type) to scroll
+        @type  query: L{ElasticQuery}
+        @param query: query to scroll with
+        @type  workers: int
+        @param workers: number of threads to run the handlers in
+        @type  queue_size: int
+        @keyword queue_size: maximum number of pages scrolled and not yet merged
+        @return: result container
+        '''
+        page_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        scroll_errors = []
+        watch_source_fields = cls.get_source_watcher(section, config)
+        page_handler = sub_class.get_page_handler(section)
+
+        def put_hits(resp_json):
+            if stop.is_set():
+                raise RuntimeError(section + ' pipeline stopped')
+            page_queue.put(resp_json['hits']['hits'])
+
+        def scroll():
+            try:
+                ScanAndScroll.scan_and_scroll(source_idx, call_fun=put_hits, query=query)
+            except Exception as e:
+                if not stop.is_set():
+                    logger.exception('Error scrolling ' + source_idx)
+                    scroll_errors.append(e)
+            finally:
+                page_queue.put(None)
+
+        def process_page(hits):
+            if watch_source_fields is not None:
+                hits = [watch_source_fields(hit) for hit in hits]
+            return page_handler(hits, section, config, {})
+
+        result_container = cls.new_result_container(section, config)
+        scroller = threading.Thread(target=scroll, name=section + '-scroll', daemon=True)
+        scroller.start()
+        scrolled = False
+        pages = collections.deque()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while not scrolled:
+                    hits = page_queue.get()
+                    if hits is None:
+                        scrolled = True
+                    else:
+                        pages.append(executor.submit(process_page, hits))
+                    while len(pages) > 0 and (scrolled or pages[0].done() or len(pages) >= queue_size):
+                        result_container = cls.merge_result_containers(result_container, pages.popleft().result())
+        except BaseException:
+            # stop the scroll, and unblock it if it is waiting on a full queue
+            stop.set()
+            while not scrolled:
+                scrolled = page_queue.get() is None
+            raise
+        finally:
+            scroller.join()
+
+        if len(scroll_errors) > 0:
+            raise scroll_errors[0]
+        return result_container
+
+    @classmethod
+    def merge_result_containers(cls, result_container, other_container):
+        ''' function to merge the results of other_container in to result_container
+        @type result_container : dict
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        @type other_container : dict
+        @keyword other_container: Container object to merge in to result_container
+        '''
+        for feature_id, criteria_disease_dict in cls.iter_result_container(other_container):
+            entries = [([feature_id], [disease], criteria_dict)
+                       for disease, criteria_list in criteria_disease_dict.items() for criteria_dict in criteria_list]
+            cls.populate_container_bulk(entries, result_container=result_container)
+            cls.check_result_container(result_container)
+        return result_container
+
+    @classmethod
+    def new_result_container(cls, section, config):
+        ''' function to create the result container for a criteria. If max_features_in_memory is set (in the
+            section or DEFAULT) a L{SpillingResultContainer} writing to spill_dir is used, if result_container
+            is columnar a L{ColumnarResultContainer}, otherwise a dict.
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        section_config = config[section]
+        max_features = int(section_config.get('max_features_in_memory', 0))
+        if max_features > 0:
+            return SpillingResultContainer(max_features=max_features, spill_dir=section_config.get('spill_dir'))
+        if section_config.get('result_container') == 'columnar':
+            return ColumnarResultContainer()
+        return {}
+
+    @classmethod
+    def check_result_container(cls, result_container):
+        ''' function to spill the result container to disk if it is over its memory budget '''
+        if isinstance(result_container, SpillingResultContainer):
+            result_container.check_budget()
+
+    @classmethod
+    def iter_result_container(cls, result_container):
+        ''' function to iterate over the (feature_id, criteria_disease_dict) of a result container '''
+        if isinstance(result_container, (SpillingResultContainer, ColumnarResultContainer)):
+            return result_container.feature_items()
+        return result_container.items()
+
+    @classmethod
+    def tag_feature_to_disease(cls, feature_doc, section, config, result_container={}):
+        ''' function to run the criteria of a section (the classmethod of the sub_class with the section name)
+            for a hit
+        @type  feature_doc: dict
+        @param feature_doc: hit from the source index
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @type result_container : dict
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        '''
+        return getattr(cls, section)(feature_doc, section, config, result_container=result_container)
+
+    @classmethod
+    def get_page_handler(cls, section):
+        ''' function to get the function processing a page of hits for a section, resolved once for the section.
+            A sub_class can process a page at a time by defining <section>_page(hits, section, config,
+            result_container), e.g. to pad or look up the hits together. Otherwise prefetch_<section>(hits, config), if
+            the sub_class defines it, primes the L{DataLoader}s with the keys of the page, which are then dispatched
+            together, and each hit is run through the criteria of the section.
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @return: function(hits, section, config, result_container) returning the result container
+        '''
+        page_handler = getattr(cls, section + '_page', None)
+        if page_handler is not None:
+            return page_handler
+
+        hit_handler = getattr(cls, section)
+        prefetch = getattr(cls, 'prefetch_' + section, None)
+
+        def process_page(hits, section, config, result_container):
+            if prefetch is not None:
+                prefetch(hits, config)
+                DataLoader.dispatch_all()
+            for hit in hits:
+                result_container = hit_handler(hit, section, config, result_container=result_container)
+            return result_container
+        return process_page
+
+    @classmethod
+    def get_first_author(cls, dil_study_id):
+        ''' Get the first author ('name initials') of a study, loading it if it is not already loaded. '''
+        first_author = cls.study_authors.load(dil_study_id)
+        if first_author is None:
+            logger.warning('study doc not found for ' + dil_study_id)
+        return first_author
 
     @classmethod
     def get_elastic_query(cls, section=None, config=None):
@@ -132,11 +644,7 @@ class Criteria():
         @return: L{Query}
         '''
         section_config = config[section]
-        source_fields = []
-
-        if 'source_fields' in section_config:
-            source_fields_str = section_config['source_fields']
-            source_fields = source_fields_str.split(',')
+        source_fields = cls.get_source_fields(section, config)
 
         if 'mhc' in section:
             seqid = '6'
@@ -169,7 +677,17 @@ class Criteria():
             gw_sig_p = 0.00000005
             query = ElasticQuery(RangeQuery("p_value", lte=gw_sig_p))
         else:
-            if len(source_fields) > 0:
+            query_filters = cls.get_query_filters(section, config)
+            since = cls.get_since(section, config)
+            if since is not None:
+                # incremental build, only the source documents changed since
+                if query_filters is None:
+                    query_filters = BoolQuery()
+                query_filters.must(RangeQuery(section_config['timestamp_field'], gte=since))
+            if query_filters is not None:
+                query = ElasticQuery.filtered_bool(Query.match_all(), query_filters,
+                                                   sources=(source_fields if len(source_fields) > 0 else None))
+            elif len(source_fields) > 0:
                 query = ElasticQuery(Query.match_all(), sources=source_fields)
             else:
                 # query = ElasticQuery(Query.match_all())
@@ -177,6 +695,133 @@ class Criteria():
 
         return query
 
+    @classmethod
+    def get_source_fields(cls, section, config):
+        ''' function to get the _source fields to scroll for a criteria: source_fields in the section, else the
+            fields the criteria class declares in SOURCE_FIELDS for the section. With debug_source_fields true
+            (in the section or DEFAULT) no projection is made and L{watch_source_fields} warns about any
+            fields read that are not declared.
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: list of fields, empty for the full documents
+        '''
+        section_config = config[section]
+        if cls.is_debug_source_fields(section, config):
+            return []
+        if 'source_fields' in section_config:
+            return [field.strip() for field in section_config['source_fields'].split(',')]
+        sub_class = CriteriaManager.get_criteria_class(section_config.get('feature'))
+        if sub_class is None:
+            return []
+        return list(sub_class.SOURCE_FIELDS.get(section, []))
+
+    @classmethod
+    def is_debug_source_fields(cls, section, config):
+        return config[section].get('debug_source_fields', 'false').lower() == 'true'
+
+    @classmethod
+    def get_source_watcher(cls, section, config):
+        ''' Get a function wrapping the _source of a hit in a L{SourceFieldsWatcher} for the declared fields of
+            the section if debug_source_fields is set, else None.
+        '''
+        if not cls.is_debug_source_fields(section, config):
+            return None
+        sub_class = CriteriaManager.get_criteria_class(config[section].get('feature'))
+        declared = set() if sub_class is None else set(sub_class.SOURCE_FIELDS.get(section, []))
+        # _id is set on the _source by the criteria
+        declared.add('_id')
+
+        def watch_source_fields(hit):
+            hit['_source'] = SourceFieldsWatcher(hit['_source'], declared, section)
+            return hit
+        return watch_source_fields
+
+    QUERY_FILTER = re.compile(r'^(!?)\s*([\w.]+)\s*(<=|>=|<|>|=)\s*(.+?)\s*$')
+    RANGE_OPS = {'<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+
+    @classmethod
+    def get_query_filters(cls, section, config):
+        ''' function to compile the query_filters of a section in to a BoolQuery so that only the hits the
+            criteria can use are scrolled. query_filters is a comma separated list of predicates, each
+            field=value (phrase), field<value, field<=value, field>value or field>=value (range), and prefixed
+            with ! to negate it, e.g. query_filters: status=N, !disease_locus=tbc. The value of field=value is
+            analyzed as the field is, so it is given as in the source docs whether or not the field is analyzed.
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: L{BoolQuery} or None if the section has no query_filters
+        @raise ValueError: if a predicate can not be parsed
+        '''
+        query_filters = config[section].get('query_filters', '').strip()
+        if query_filters == '':
+            return None
+
+        bool_query = BoolQuery()
+        for query_filter in query_filters.split(','):
+            match = cls.QUERY_FILTER.match(query_filter.strip())
+            if match is None:
+                raise ValueError(section + ': unrecognised query filter ' + query_filter)
+            (negate, field, op, value) = match.groups()
+            if op == '=':
+                predicate = Query.query_string('"' + value + '"', fields=[field])
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+                predicate = RangeQuery(field, **{cls.RANGE_OPS[op]: value})
+
+            if negate:
+                bool_query.must_not(predicate)
+            else:
+                bool_query.must(predicate)
+        return bool_query
+
+    @classmethod
+    def get_since(cls, section, config):
+        ''' function to get the time from which an incremental build (since, set in the DEFAULT section by
+            criteria_index --since) rebuilds a criteria. Only the source documents with timestamp_field (in the
+            section) at or after the time are scrolled. since is a time (e.g. 2016-05-20 or 2016-05-20T10:30:00),
+            a build id (e.g. 20160520103000, see L{get_build_meta}) or 'last' for the time of the last build
+            recorded in the _meta of the criteria.
+        @type  section: string
+        @keyword section: The section in the criteria.ini file
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: the time (BUILD_TIME_FORMAT) or None to build the criteria in full
+        '''
+        section_config = config[section]
+        since = section_config.get('since', '').strip()
+        if since == '':
+            return None
+        if 'timestamp_field' not in section_config:
+            logger.warning(section + ' has no timestamp_field, building in full')
+            return None
+
+        if since == 'last':
+            meta = cls.get_meta_info(cls.get_criteria_idx(section_config['feature'], config), section)
+            if meta is None or 'build_time' not in meta:
+                logger.warning(section + ' has no recorded build, building in full')
+                return None
+            return meta['build_time']
+
+        for time_format in (BUILD_ID_FORMAT, BUILD_TIME_FORMAT, '%Y-%m-%d'):
+            try:
+                return datetime.datetime.strptime(since, time_format).strftime(BUILD_TIME_FORMAT)
+            except ValueError:
+                pass
+        raise ValueError('since is not a build id or time: ' + since)
+
+    @classmethod
+    def get_build_meta(cls):
+        ''' function to get the build id and time of a build (starting now), recorded in the _meta of the
+            criteria built (see L{get_since}) '''
+        now = datetime.datetime.now()
+        return {'build_id': now.strftime(BUILD_ID_FORMAT), 'build_time': now.strftime(BUILD_TIME_FORMAT)}
+
     @classmethod
     def tag_feature_to_all_diseases(cls, feature_id, section, config, result_container={}):
         ''' function to tag the feature to all the diseases, used to tag features in the MHC region
@@ -192,34 +837,17 @@ class Criteria():
 #         (main_codes, other_codes) = CriteriaManager.get_available_diseases()
 #         all_diseases = main_codes + other_codes
 
-        result_container_ = result_container
         if config is None:
             config = IniParser.read_ini(ini_file='criteria.ini')
 
-        dis_dict = dict()
-        criteria_disease_dict = {}
-
-        for disease in cls.site_enabled_diseases:
-                dis_dict[disease] = []
-                criteria_dict = cls.get_criteria_dict(disease, disease)
-                if len(result_container_.get(feature_id, {})) > 0:
-
-                    criteria_disease_dict = result_container_[feature_id]
-                    criteria_disease_dict = cls.get_criteria_disease_dict([disease], criteria_dict,
-                                                                          criteria_disease_dict)
-
-                    result_container_[feature_id] = criteria_disease_dict
-                else:
-                    criteria_disease_dict = {}
-                    criteria_disease_dict = cls.get_criteria_disease_dict([disease], criteria_dict,
-                                                                          criteria_disease_dict)
-                    result_container_[feature_id] = criteria_disease_dict
-
-        return result_container_
+        entries = [([feature_id], [disease], cls.get_criteria_dict(disease, disease))
+                   for disease in cls.site_enabled_diseases]
+        return cls.populate_container_bulk(entries, result_container=result_container)
 
     @classmethod
-    def map_and_load(cls, feature, section, config, result_container={}):
-        ''' function to map and load the results in to elastic index
+    def map_and_load(cls, feature, section, config, result_container={}, build_meta=None):
+        ''' function to map and load the results in to elastic index. In an incremental build (see L{get_since})
+            the results are merged with the documents already loaded for the features.
         @type  feature: string
         @param feature: feature type, could be 'gene','region', 'marker' etc.,
         @type  section: string
@@ -228,17 +856,161 @@ class Criteria():
         @keyword config: The config object initialized from criteria.ini.
         @type result_container : string
         @keyword result_container: Container object for storing the result with keys as the feature_id
+        @type  build_meta: dict
+        @keyword build_meta: build id and time to record in the _meta (see L{get_build_meta})
+        '''
+        criteria_idx = cls.get_criteria_idx(feature, config)
+        criteria_idx_type = section
+
+        if cls.get_since(section, config) is not None:
+            result_container = cls.merge_loaded_docs(result_container, criteria_idx, criteria_idx_type)
+            logger.warning(criteria_idx + ' ' + criteria_idx_type + ' incremental build of ' +
+                           str(len(result_container)) + ' features')
+
+        cls.create_criteria_mapping(criteria_idx, criteria_idx_type, build_meta=build_meta)
+        bulk_settings = cls.start_bulk_mode(criteria_idx, feature, config)
+        try:
+            cls.load_result_container(result_container, criteria_idx, criteria_idx_type,
+                                      **cls.get_bulk_options(section, config))
+        finally:
+            cls.end_bulk_mode(criteria_idx, bulk_settings)
+        logger.warning(criteria_idx + ' ' + criteria_idx_type + ' loaded successfully. DONE')
+
+    @classmethod
+    def merge_loaded_docs(cls, result_container, idx, idx_type, chunk_size=1000):
+        ''' function to merge the criteria already loaded for the features of a result container (e.g. of an
+            incremental build) with the results. The features are fetched from the criteria index by id in chunks.
+            Criteria are only added, so a source document that no longer tags a feature needs a full build.
+        @type result_container : dict
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        @type  idx: string
+        @param idx: name of the criteria index
+        @type  idx_type: string
+        @param idx_type: name of the idx type, each criteria is an index type
+        @return: dict result container of the merged features
         '''
+        merged_container = {}
+        features = list(cls.iter_result_container(result_container))
+        for i in range(0, len(features), chunk_size):
+            chunk = features[i:i + chunk_size]
+            loaded_docs = {}
+
+            def add_loaded_docs(resp_json):
+                for hit in resp_json['hits']['hits']:
+                    loaded_docs[hit['_id']] = hit['_source']
+
+            query = ElasticQuery(Query.ids([feature_id for (feature_id, _row) in chunk]))
+            ScanAndScroll.scan_and_scroll(idx + '/' + idx_type, call_fun=add_loaded_docs, query=query)
+
+            entries = []
+            for (feature_id, criteria_disease_dict) in chunk:
+                for row in (loaded_docs.get(feature_id, {}), criteria_disease_dict):
+                    entries.extend(([feature_id], [disease], criteria_dict)
+                                   for disease, criteria_list in row.items()
+                                   if disease not in ('score', 'disease_tags', 'qid')
+                                   for criteria_dict in criteria_list)
+            cls.populate_container_bulk(entries, result_container=merged_container)
+        return merged_container
+
+    @classmethod
+    def get_criteria_idx(cls, feature, config):
+        ''' function to get the criteria index name for a feature (CRITERIA_IDX_<FEATURE> in criteria.ini) '''
         feature_upper = feature.upper()
         criteria_type = 'CRITERIA_IDX_' + feature_upper
 
         default_section = config['DEFAULT']
-        criteria_idx = default_section[criteria_type]
-        criteria_idx_type = section
+        return default_section[criteria_type]
 
-        cls.create_criteria_mapping(criteria_idx, criteria_idx_type)
-        cls.load_result_container(result_container, criteria_idx, criteria_idx_type)
-        logger.warning(criteria_idx + ' ' + criteria_idx_type + ' loaded successfully. DONE')
+    @classmethod
+    def get_bulk_options(cls, section, config):
+        ''' function to get the bulk loading options (see L{load_result_container}) for a criteria '''
+        section_config = config[section]
+        return {'max_bytes': int(section_config.get('bulk_max_bytes', 5242880)),
+                'workers': int(section_config.get('bulk_workers', 2)),
+                'queue_size': int(section_config.get('bulk_queue_size', 4))}
+
+    @classmethod
+    def is_bulk_mode(cls, feature, config):
+        ''' function to check if the criteria index of a feature is loaded in bulk mode (bulk_mode_<feature> in
+            the DEFAULT section), see L{start_bulk_mode} '''
+        return config['DEFAULT'].get('bulk_mode_' + feature, 'false').lower() == 'true'
+
+    @classmethod
+    def start_bulk_mode(cls, idx, feature, config):
+        ''' function to turn off refresh and replicas of a criteria index while it is loaded, if the feature
+            is in bulk mode. The settings they replace are returned to be restored by L{end_bulk_mode}, in a
+            finally once the load is done. If the index is already in bulk mode (another criteria of the
+            feature is loading) the settings are left to the load that turned it on.
+        @type  idx: string
+        @param idx: name of the index
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        @return: the previous refresh_interval and number_of_replicas, or None if there is nothing to restore
+        '''
+        if not cls.is_bulk_mode(feature, config):
+            return None
+        idx_settings = cls.get_idx_settings(idx)
+        if idx_settings is None or idx_settings.get('refresh_interval') == '-1':
+            return None
+        bulk_settings = {"refresh_interval": idx_settings.get('refresh_interval', '1s'),
+                         "number_of_replicas": int(idx_settings.get('number_of_replicas', 1))}
+        if not cls.put_idx_settings(idx, {"refresh_interval": "-1", "number_of_replicas": 0}):
+            return None
+        return bulk_settings
+
+    @classmethod
+    def end_bulk_mode(cls, idx, bulk_settings):
+        ''' function to restore the refresh interval and replicas of a criteria index loaded in bulk mode and
+            refresh it.
+        @type  idx: string
+        @param idx: name of the index
+        @type  bulk_settings: dict
+        @param bulk_settings: the settings returned by L{start_bulk_mode}, None if it did not change them
+        '''
+        if bulk_settings is None:
+            return
+        if cls.put_idx_settings(idx, bulk_settings):
+            Search.index_refresh(idx)
+
+    @classmethod
+    def force_merge(cls, feature, config):
+        ''' function to merge the criteria index of a feature loaded in bulk mode to the number of segments
+            set by force_merge_<feature> in the DEFAULT section, if it is set.
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  config:  string
+        @keyword config: The config object initialized from criteria.ini.
+        '''
+        max_num_segments = config['DEFAULT'].get('force_merge_' + feature, '').strip()
+        if not cls.is_bulk_mode(feature, config) or max_num_segments == '':
+            return
+        idx = cls.get_criteria_idx(feature, config)
+        logger.warning('Merging ' + idx + ' to ' + max_num_segments + ' segments')
+        resp = requests.post(ElasticSettings.url() + '/' + idx + '/_optimize?max_num_segments=' + max_num_segments)
+        if resp.status_code != 200:
+            logger.warning('Merging ' + idx + ' failed: ' + resp.text)
+
+    @classmethod
+    def get_idx_settings(cls, idx):
+        ''' function to get the index settings of an index (or the index an alias is on), or None if there is
+            no such index '''
+        resp = requests.get(ElasticSettings.url() + '/' + idx + '/_settings')
+        if resp.status_code != 200:
+            logger.warning('Failed to get the settings of ' + idx + ': ' + resp.text)
+            return None
+        idx_settings = list(resp.json().values())
+        return idx_settings[0]['settings']['index'] if len(idx_settings) > 0 else None
+
+    @classmethod
+    def put_idx_settings(cls, idx, settings):
+        ''' function to update the (dynamic) settings of an index, returning False if they were not updated '''
+        resp = requests.put(ElasticSettings.url() + '/' + idx + '/_settings', data=json.dumps({"index": settings}))
+        if resp.status_code != 200:
+            logger.warning('Failed to update the settings of ' + idx + ': ' + resp.text)
+            return False
+        return True
 
     @classmethod
     def get_criteria_dict(cls, fid, fname, fnotes={}):
@@ -273,16 +1045,17 @@ class Criteria():
         for disease in diseases:
             if disease in criteria_disease_dict:
                 existing_dict = criteria_disease_dict[disease]
-                if criteria_dict not in existing_dict:
-                        existing_dict.append(criteria_dict)
-                        criteria_disease_dict[disease] = existing_dict
+                if not isinstance(existing_dict, CriteriaList):
+                    existing_dict = CriteriaList(existing_dict)
+                    criteria_disease_dict[disease] = existing_dict
+                existing_dict.add(criteria_dict)
             else:
-                criteria_disease_dict[disease] = [criteria_dict]
+                criteria_disease_dict[disease] = CriteriaList([criteria_dict])
 
         return criteria_disease_dict
 
     @classmethod
-    def create_criteria_mapping(cls, idx, idx_type, test_mode=False):
+    def create_criteria_mapping(cls, idx, idx_type, test_mode=False, build_meta=None):
         ''' function to create mapping for criteria indexes
         @type  idx: string
         @param idx: name of the index
@@ -290,6 +1063,8 @@ class Criteria():
         @param idx_type: name of the idx type, each criteria is an index type
         @type  test_mode:  string
         @param test_mode: flag to create or not create the mapping
+        @type  build_meta: dict
+        @keyword build_meta: build id and time to add to the _meta (see L{get_build_meta})
         '''
         logger.warning('Idx ' + idx)
         logger.warning('Idx_type ' + idx_type)
@@ -322,6 +1097,8 @@ class Criteria():
         idx_type_cfg = config[idx_type]
         desc = idx_type_cfg['desc']
         meta = {"desc": desc}
+        if build_meta is not None:
+            meta.update(build_meta)
         if not test_mode:
             load.mapping(props, idx_type, meta=meta, analyzer=Loader.KEYWORD_ANALYZER, **options)
         return props
@@ -406,7 +1183,7 @@ class Criteria():
         return score
 
     @classmethod
-    def load_result_container(cls, result_container, idx, idx_type):
+    def load_result_container(cls, result_container, idx, idx_type, max_bytes=5242880, workers=2, queue_size=4):
         ''' function to load the results in to index using the bulk loader
         @type result_container : string
         @keyword result_container: Container object for storing the result with keys as the feature_id
@@ -414,17 +1191,35 @@ class Criteria():
         @param idx: name of the index
         @type  idx_type: string
         @param idx_type: name of the idx type, each criteria is an index type
+        @type  max_bytes: int
+        @keyword max_bytes: maximum size in bytes of each bulk request
+        @type  workers: int
+        @keyword workers: number of threads sending bulk requests (see L{BulkLoader})
+        @type  queue_size: int
+        @keyword queue_size: maximum number of bulk requests waiting to be sent
         '''
-        json_data = ''
-        line_num = 0
+        loader = BulkLoader(idx, idx_type, workers=workers, queue_size=queue_size)
+        encoder = BulkEncoder(idx, idx_type, flush_fun=loader.submit, max_bytes=max_bytes)
+        try:
+            cls.encode_result_container(encoder, result_container)
+            encoder.close()
+        finally:
+            loader.close()
 
-        for feature_id in result_container:
+    @classmethod
+    def encode_result_container(cls, encoder, result_container):
+        ''' function to add the score, disease_tags and qid to each feature in the result container and
+            add them to the bulk encoder
+        @type  encoder: L{BulkEncoder}
+        @param encoder: bulk encoder
+        @type result_container : string
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        '''
+        for feature_id, row in cls.iter_result_container(result_container):
 
             if feature_id is None:
                 continue
 
-            row_obj = {"index": {"_index": idx, "_type": idx_type, "_id": feature_id}}
-            row = result_container[feature_id]
             disease_tags = list(row.keys())
 
             if 'score' in disease_tags:
@@ -437,18 +1232,7 @@ class Criteria():
             row['disease_tags'] = disease_tags
             row['qid'] = feature_id
 
-            json_data += json.dumps(row_obj) + '\n'
-            json_data += json.dumps(row) + '\n'
-
-            line_num += 1
-
-            if(line_num > 5000):
-                line_num = 0
-                print('.', end="", flush=True)
-                Loader().bulk_load(idx, idx_type, json_data)
-                json_data = ''
-        if line_num > 0:
-            Loader().bulk_load(idx, idx_type, json_data)
+            encoder.add(feature_id, row)
 
     @classmethod
     def populate_container(cls, fid, fname, fnotes=None, features=None, diseases=None, result_container={}):
@@ -469,34 +1253,39 @@ class Criteria():
         @keyword result_container: Container object for storing the result with keys as the feature_id
         '''
 
-        result_container_ = result_container
-
         criteria_dict = cls.get_criteria_dict(fid, fname, fnotes)
+        return cls.populate_container_bulk([(features, diseases, criteria_dict)], result_container=result_container)
 
-        dis_dict = dict()
-        criteria_disease_dict = {}
-        for feature in features:
-
-            if feature is None:
+    @classmethod
+    def populate_container_bulk(cls, entries, result_container={}):
+        ''' function to populate the result container with many results (eg. from a page of hits) in a single pass
+        @type  entries: list
+        @param entries: (features, diseases, criteria_dict) tuples; criteria_dict (see L{get_criteria_dict})
+                        is tagged to each of the diseases of each of the features
+        @type result_container : string
+        @keyword result_container: Container object for storing the result with keys as the feature_id
+        '''
+        if isinstance(result_container, ColumnarResultContainer):
+            for (features, diseases, criteria_dict) in entries:
+                result_container.add(features, diseases, criteria_dict)
+            return result_container
+
+        for (features, diseases, criteria_dict) in entries:
+            diseases = list(diseases)
+            if len(diseases) == 0:
                 continue
 
-            for disease in diseases:
-
-                dis_dict[disease] = []
-                if len(result_container_.get(feature, {})) > 0:
-
-                    criteria_disease_dict = result_container_[feature]
-                    criteria_disease_dict = cls.get_criteria_disease_dict(diseases, criteria_dict,
-                                                                          criteria_disease_dict)
+            for feature in features:
+                if feature is None:
+                    continue
 
-                    result_container_[feature] = criteria_disease_dict
-                else:
+                criteria_disease_dict = result_container.get(feature)
+                if criteria_disease_dict is None:
                     criteria_disease_dict = {}
-                    criteria_disease_dict = cls.get_criteria_disease_dict(diseases, criteria_dict,
-                                                                          criteria_disease_dict)
-                    result_container_[feature] = criteria_disease_dict
+                    result_container[feature] = criteria_disease_dict
+                cls.get_criteria_disease_dict(diseases, criteria_dict, criteria_disease_dict)
 
-        return result_container_
+        return result_container
 
     @classmethod
     def get_available_criterias(cls, feature=None, config=None, test=False):
@@ -604,17 +1393,18 @@ class Criteria():
         meta_info = {}
 
         criteria_disease_tags = {}
+        # the hits are all from idx, which may be an alias (see VersionedIndex), so their _index is not compared
         for hit in hits:
-            if idx == hit['_index']:
-                qid = hit['_source']['qid']
+            qid = hit['_source']['qid']
+            if hit['_type'] not in meta_info:
                 meta_desc = cls.get_meta_desc(idx, [hit['_type']])
                 meta_info[hit['_type']] = meta_desc[idx][hit['_type']]
 
-                criteria_desc = hit['_type']
+            criteria_desc = hit['_type']
 
-                if qid not in criteria_disease_tags:
-                    criteria_disease_tags[qid] = {}
-                criteria_disease_tags[qid][criteria_desc] = hit['_source']['disease_tags']
+            if qid not in criteria_disease_tags:
+                criteria_disease_tags[qid] = {}
+            criteria_disease_tags[qid][criteria_desc] = hit['_source']['disease_tags']
 
         disease_tags_all = []
         for fid, fvalue in criteria_disease_tags.items():
@@ -645,7 +1435,9 @@ class Criteria():
 
         try:
             elastic_meta = json.loads(meta_response.content.decode("utf-8"))
-            meta_info = elastic_meta[idx]['mappings'][idx_type]['_meta']
+            # the mappings of an alias (see VersionedIndex) are keyed by the index it is on
+            idx_meta = elastic_meta[idx] if idx in elastic_meta else list(elastic_meta.values())[0]
+            meta_info = idx_meta['mappings'][idx_type]['_meta']
             return meta_info
         except:
             return None
@@ -865,3 +1657,34 @@ class Criteria():
         if len(hits) > 0:
             regions = Region.hits_to_regions(hits)
             return regions
+
+
+def process_slice(sub_class, section, config, page_queue, result_queue, in_process=True):
+    ''' Worker process for L{Criteria.scan_in_slices}. Processes pages of hits from page_queue until
+    None is received and puts (success, result container or error) on result_queue. A worker process
+    (in_process) closes the connections it opened, threads leave them to the build. '''
+    result_container = Criteria.new_result_container(section, config)
+    watch_source_fields = Criteria.get_source_watcher(section, config)
+    process_page = sub_class.get_page_handler(section)
+    error = None
+    while True:
+        hits = page_queue.get()
+        if hits is None:
+            break
+        if error is not None:
+            continue
+        try:
+            if watch_source_fields is not None:
+                hits = [watch_source_fields(hit) for hit in hits]
+            result_container = process_page(hits, section, config, result_container)
+            Criteria.check_result_container(result_container)
+        except Exception as e:
+            logger.exception('Error processing ' + section + ' slice')
+            error = repr(e)
+
+    if in_process:
+        sub_class.close_connections()
+    if error is not None:
+        result_queue.put((False, error))
+    else:
+        result_queue.put((True, result_container))
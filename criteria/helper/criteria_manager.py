@@ -4,6 +4,8 @@ import os
 from builtins import classmethod
 from disease import utils
 import datetime
+import time
+import concurrent.futures
 from pydgin_auth.elastic_model_factory import ElasticPermissionModelFactory as elastic_factory
 
 # Get an instance of a logger
@@ -45,21 +47,58 @@ class CriteriaManager():
             return (main_codes, other_codes)
 
     @classmethod
-    def process_criterias(cls, feature, criteria=None, config=None, show=False, test=False):
-        '''function to delegate the call to the right criteria class and build the criteria for that class
+    def get_criteria_class(cls, feature):
+        '''function to get the criteria class implementing the criterias of a feature
         '''
-        from criteria.helper.criteria import Criteria
         from criteria.helper.gene_criteria import GeneCriteria
         from criteria.helper.marker_criteria import MarkerCriteria
         from criteria.helper.region_criteria import RegionCriteria
         from criteria.helper.study_criteria import StudyCriteria
 
+        criteria_classes = {'gene': GeneCriteria, 'marker': MarkerCriteria,
+                            'region': RegionCriteria, 'study': StudyCriteria}
+        return criteria_classes.get(feature)
+
+    @classmethod
+    def get_build_weight(cls, section, config):
+        '''function to get the relative build cost of a criteria (build_weight in criteria.ini, default 1)
+        '''
+        section_config = config[section]
+        if 'build_weight' in section_config:
+            return float(section_config['build_weight'])
+        return 1
+
+    @classmethod
+    def process_criterias(cls, feature, criteria=None, config=None, show=False, test=False, workers=1, slices=None,
+                          shared_scan=False, since=None, replace_unversioned=False):
+        '''function to delegate the call to the right criteria class and build the criteria for that class.
+        With workers > 1 the criterias are built in a process pool, the most expensive ones first.
+        slices sets the number of worker processes used to process the source index of each criteria.
+        With shared_scan the criterias reading the same source index are built from a single scroll.
+        With versioned_index set in the DEFAULT section the criterias are built in to a new version of the
+        index that replaces the live one when they are all built (see VersionedIndex). With replace_unversioned
+        an index built before versioning is copied to the first version and replaced by the alias.
+        With bulk_mode_<feature> set in the DEFAULT section the index is loaded with refresh and replicas off,
+        which are restored after each load, and merged (force_merge_<feature>) when the criterias are built
+        (see Criteria.start_bulk_mode).
+        With since (a time, build id or 'last') the criterias with a timestamp_field are built incrementally
+        from the source documents changed since (see Criteria.get_since).
+        Returns a dict of the criterias that failed to build with the error.
+        '''
+        from criteria.helper.criteria import Criteria
+        from criteria.helper.versioned_index import VersionedIndex
+
         if config is None:
             if test:
                 config = cls.get_criteria_config(ini_file='test_criteria.ini')
             else:
                 config = cls.get_criteria_config(ini_file='criteria.ini')
 
+        if since is not None:
+            config['DEFAULT']['since'] = since
+        if replace_unversioned:
+            config['DEFAULT']['replace_unversioned'] = 'true'
+
         available_criterias = Criteria.get_available_criterias(feature, config=config, test=test)[feature]
 
         criterias_to_process = []
@@ -74,22 +113,86 @@ class CriteriaManager():
             print(criterias_to_process)
             return criterias_to_process
 
+        if cls.get_criteria_class(feature) is None:
+            logger.critical('Unsupported feature ... please check the inputs')
+            return {}
+
+        if shared_scan and not test:
+            section_groups = Criteria.group_by_source(criterias_to_process, config)
+        else:
+            section_groups = [[section] for section in criterias_to_process]
+
         logger.debug(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'))
-        for section in criterias_to_process:
-            if feature == 'gene':
-                print('Call to build criteria gene index')
-                Criteria.process_criteria(feature, section, config, GeneCriteria, test=test)
-            elif feature == 'marker':
-                print('Call to build criteria marker index')
-                Criteria.process_criteria(feature, section, config, MarkerCriteria, test=test)
-            elif feature == 'region':
-                print('Call to build criteria region index')
-                Criteria.process_criteria(feature, section, config, RegionCriteria, test=test)
-            elif feature == 'study':
-                print('Call to build criteria study index')
-                Criteria.process_criteria(feature, section, config, StudyCriteria, test=test)
+        versioned = not test and len(criterias_to_process) > 0 and VersionedIndex.is_versioned(config)
+        if versioned:
+            (alias, live_idx, version_idx) = VersionedIndex.start_build(feature, criterias_to_process, config)
+
+        failed = {}
+        try:
+            if workers is not None and workers > 1:
+                failed = cls.process_criterias_parallel(feature, section_groups, config, test=test, workers=workers,
+                                                        slices=slices)
             else:
-                logger.critical('Unsupported feature ... please check the inputs')
+                for sections in section_groups:
+                    print('Call to build criteria ' + feature + ' index')
+                    build_criteria_sections(feature, sections, config, test=test, slices=slices)
+        except Exception:
+            if versioned:
+                VersionedIndex.abort_build(version_idx)
+            raise
+
+        if not test and not failed:
+            Criteria.force_merge(feature, config)
+        if versioned:
+            if failed:
+                VersionedIndex.abort_build(version_idx)
+            else:
+                VersionedIndex.finish_build(alias, live_idx, version_idx, config)
 
         logger.debug(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'))
         logger.debug('========DONE==========')
+        return failed
+
+    @classmethod
+    def process_criterias_parallel(cls, feature, section_groups, config, test=False, workers=2, slices=None):
+        '''function to build the groups of criterias in a pool of worker processes. The groups are submitted
+        longest (highest build_weight) first so that the pool is not left waiting on a big one at the end.
+        '''
+        section_groups = sorted(section_groups, reverse=True,
+                                key=lambda sections: sum(cls.get_build_weight(section, config) for section in sections))
+        failed = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(build_criteria_sections, feature, sections, config, test, slices): sections
+                       for sections in section_groups}
+            for future in concurrent.futures.as_completed(futures):
+                sections = futures[future]
+                try:
+                    elapsed = future.result()
+                    logger.warning(','.join(sections) + ' built in ' + str(round(elapsed)) + 's')
+                except Exception as e:
+                    for section in sections:
+                        failed[section] = repr(e)
+                    logger.critical(','.join(sections) + ' failed: ' + repr(e))
+        return failed
+
+
+def build_criteria_sections(feature, sections, config, test=False, slices=None):
+    '''Build a criteria section, or a group of sections sharing a source index scroll; module level so that
+    it can be run in a worker process. Returns the time taken in seconds.
+    '''
+    from criteria.helper.criteria import Criteria
+
+    start = time.time()
+    sub_class = CriteriaManager.get_criteria_class(feature)
+    try:
+        if len(sections) > 1:
+            Criteria.process_criteria_group(feature, sections, config, sub_class)
+        else:
+            Criteria.process_criteria(feature, sections[0], config, sub_class, test=test, slices=slices)
+    except Exception:
+        logger.exception('Error building criteria ' + ','.join(sections))
+        raise
+    finally:
+        sub_class.close_connections()
+        sub_class.clear_caches()
+    return time.time() - start
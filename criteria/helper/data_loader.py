@@ -0,0 +1,159 @@
+import logging
+import threading
+from elastic.elastic_settings import ElasticSettings
+from elastic.query import Query
+from elastic.result import Document
+from elastic.search import ElasticQuery, ScanAndScroll, Search
+
+
+logger = logging.getLogger(__name__)
+
+
+class DataLoader():
+    ''' Batching loader for the documents criteria look up by id (or by the value of a field). Keys are primed,
+    e.g. for a page of hits, and fetched together by dispatch with an ids (or terms) query per chunk_size keys.
+    Values are memoised for the run, so a handler can load the documents it needs one at a time and only the
+    keys not already loaded are fetched. The value of a key is value_fun(doc), or None if there is no doc.
+    A field value may be in several docs, so when a chunk has more hits than keys its query is scrolled
+    rather than a page of it being taken, which could leave out every doc of some keys.
+    A loader may be shared by the threads of a pipelined scan. The fetches are made outside the lock, so those
+    of different keys run concurrently, and a thread needing keys another thread is fetching waits for them
+    rather than fetching them again. '''
+
+    # all the loaders, see dispatch_all
+    loaders = []
+
+    def __init__(self, idx, idx_type, field=None, sources=None, value_fun=None, chunk_size=1000):
+        '''
+        @type  idx: string
+        @param idx: index key in the elastic settings (e.g. 'STUDY')
+        @type  idx_type: string
+        @param idx_type: idx type key in the elastic settings (e.g. 'STUDY')
+        @type  field: string
+        @keyword field: field the keys are values of, with a terms query (default: the document ids)
+        @type  sources: list
+        @keyword sources: _source fields to fetch
+        @type  value_fun: function
+        @keyword value_fun: function giving the value to keep for a doc (default: the doc)
+        @type  chunk_size: int
+        @keyword chunk_size: maximum number of keys in a request
+        '''
+        self.idx = idx
+        self.idx_type = idx_type
+        self.field = field
+        self.sources = sources
+        self.value_fun = value_fun
+        self.chunk_size = chunk_size
+        self.cache = {}
+        self.pending = set()
+        # the keys being fetched, with the event set when their fetch is done
+        self.in_flight = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        DataLoader.loaders.append(self)
+
+    def prime(self, keys):
+        ''' Queue the keys not already loaded (or being fetched) to be fetched by the next dispatch. '''
+        with self.lock:
+            self.pending.update(key for key in keys
+                                if key is not None and key not in self.cache and key not in self.in_flight)
+
+    def load(self, key):
+        ''' Get the value for a key, fetching it (and any keys primed) if it is not already loaded. '''
+        return self.load_many([key])[0]
+
+    def load_many(self, keys):
+        ''' Get the values for a list of keys, fetching those not already loaded together and waiting for
+        those being fetched by another thread. '''
+        keys = list(keys)
+        wanted = [key for key in keys if key is not None]
+        while True:
+            self.prime(wanted)
+            self.dispatch()
+            with self.lock:
+                events = set(self.in_flight[key] for key in wanted if key in self.in_flight)
+                missing = [key for key in wanted if key not in self.cache and key not in self.in_flight]
+                if len(events) == 0 and len(missing) == 0:
+                    return [None if key is None else self.cache[key] for key in keys]
+            # wait for the fetches of other threads, the keys of one that failed are fetched again
+            for event in events:
+                event.wait()
+
+    def dispatch(self):
+        ''' Fetch the primed keys. '''
+        with self.lock:
+            keys = [key for key in self.pending if key not in self.cache and key not in self.in_flight]
+            self.pending = set()
+            if len(keys) == 0:
+                return
+            done = threading.Event()
+            for key in keys:
+                self.in_flight[key] = done
+
+        try:
+            values = self.fetch(keys)
+            with self.lock:
+                self.cache.update(values)
+        finally:
+            with self.lock:
+                for key in keys:
+                    del self.in_flight[key]
+            done.set()
+
+    def fetch(self, keys):
+        ''' Fetch the values of keys, with a request per chunk_size keys. '''
+        values = {}
+        idx = ElasticSettings.idx(self.idx, idx_type=self.idx_type)
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            if self.field is None:
+                query = ElasticQuery(Query.ids(chunk), sources=self.sources)
+            else:
+                query = ElasticQuery(Query.terms(self.field, chunk), sources=self.sources)
+            result = Search(search_query=query, idx=idx, size=len(chunk)).search()
+            docs = result.docs
+            nrequests = 1
+            if result.hits_total > len(docs):
+                docs = self.scroll(query, idx)
+                nrequests += 1
+            with self.lock:
+                self.requests += nrequests
+
+            found = {}
+            for doc in docs:
+                key = doc.doc_id() if self.field is None else getattr(doc, self.field)
+                # as with a search of a single key, the first doc found is used
+                found.setdefault(key, doc)
+
+            for key in chunk:
+                doc = found.get(key)
+                values[key] = None if doc is None else (doc if self.value_fun is None else self.value_fun(doc))
+        return values
+
+    def scroll(self, query, idx):
+        ''' Get all the docs matching a query. '''
+        docs = []
+
+        def add_docs(resp_json):
+            docs.extend(Document(hit) for hit in resp_json['hits']['hits'])
+
+        ScanAndScroll.scan_and_scroll(idx, call_fun=add_docs, query=query)
+        return docs
+
+    def clear(self):
+        ''' Forget the loaded values. '''
+        with self.lock:
+            self.cache.clear()
+            self.pending.clear()
+
+    @classmethod
+    def dispatch_all(cls):
+        ''' Fetch the primed keys of all the loaders. '''
+        for loader in cls.loaders:
+            loader.dispatch()
+
+    @classmethod
+    def clear_all(cls):
+        ''' Forget the loaded values of all the loaders. '''
+        for loader in cls.loaders:
+            loader.clear()
@@ -1,16 +1,35 @@
 import logging
 from builtins import classmethod
-from elastic.search import ElasticQuery, Search
-from elastic.query import Query, BoolQuery
+from elastic.search import ElasticQuery, Search, ScanAndScroll
+from elastic.query import Query
 from elastic.elastic_settings import ElasticSettings
 from criteria.helper.criteria import Criteria
 from region import utils
 from elastic.result import Document
 from criteria.helper.criteria_manager import CriteriaManager
+from criteria.helper.intervals import IntervalIndex, IntervalJoin
+from criteria.helper.data_loader import DataLoader
 
 logger = logging.getLogger(__name__)
 
 
+def exonic_genes(marker_doc):
+    ''' Ensembl ids of the genes of a marker doc with exonic functional info, or None. '''
+    from marker.templatetags.marker_tags import marker_functional_info
+    from marker.templatetags.marker_tags import gene_info
+
+    # functional information from the bitfield in the INFO column
+    # ftp://ftp.ncbi.nlm.nih.gov/snp/specs/dbSNP_BitField_latest.pdf
+    functional_info = marker_functional_info(marker_doc)
+
+    if functional_info['has non-synonymous missense'] or\
+        functional_info['has synonymous'] or functional_info['has non-synonymous frameshift'] or\
+        functional_info['has reference'] or functional_info['has stop gain'] or\
+            functional_info['has stop loss']:
+        return list(gene_info(marker_doc).values())
+    return None
+
+
 class GeneCriteria(Criteria):
 
     ''' GeneCriteria class define functions for building gene criterias, each as separate index types
@@ -18,6 +37,21 @@ class GeneCriteria(Criteria):
     '''
     FEATURE_TYPE = 'gene'
 
+    SOURCE_FIELDS = {
+        'cand_gene_in_study': ['genes', 'diseases', 'study_id', 'authors'],
+        'cand_gene_in_region': ['genes', 'disease', 'status', 'disease_locus'],
+        'exonic_index_snp_in_gene': ['marker', 'disease', 'status', 'disease_locus', 'dil_study_id'],
+    }
+
+    # study hit interval indices (by build) and regions of study hits, kept for the run
+    study_hit_indices = {}
+    hit_region_docs = {}
+    # gene interval join
+    gene_join = None
+    # gene docs (positions), and the exonic genes of markers (None if the marker is not exonic or not found)
+    gene_docs = DataLoader('GENE', 'GENE', sources=['chromosome', 'start', 'stop'])
+    marker_exonic_genes = DataLoader('MARKER', 'MARKER', field='id', sources=['id', 'info'], value_fun=exonic_genes)
+
     @classmethod
     def cand_gene_in_study(cls, hit, section=None, config=None, result_container={}):
         '''function that implements the cand_gene_in_study criteria
@@ -71,54 +105,89 @@ class GeneCriteria(Criteria):
         if status != 'N':
             return result_container
 
-        region_index = ElasticSettings.idx('REGION', idx_type='STUDY_HITS')
-        (region_idx, region_idx_type) = region_index.split('/')
+        build = "38"  # get it from index name genes_hg38_v0.0.2 TODO
+        study_hit_index = cls.get_study_hit_index(build)
 
-        # print(region_idx + '  ' + region_idx_type)
-
-        gene_dict = cls.get_gene_docs_by_ensembl_id(genes, sources=['chromosome', 'start', 'stop'])
-
-        for gene in gene_dict:
+        entries = []
+        for (gene, gene_doc) in zip(genes, cls.gene_docs.load_many(genes)):
+            if gene_doc is None:
+                continue
             # get position
-            gene_doc = gene_dict[gene]
-            # print(gene_doc.__dict__)
-            build = "38"  # get it from index name genes_hg38_v0.0.2 TODO
             seqid = getattr(gene_doc, "chromosome")
             start = getattr(gene_doc, "start")
             stop = getattr(gene_doc, "stop")
             # check if they overlap a region
-            overlapping_region_docs = cls.fetch_overlapping_features(build, seqid, start, stop,
-                                                                     idx=region_idx, idx_type=region_idx_type)
+            overlapping_region_docs = study_hit_index.overlaps(seqid, start, stop)
 
-            region_docs = utils.Region.hits_to_regions(overlapping_region_docs)
+            region_docs = cls.hits_to_regions(overlapping_region_docs)
 
             if(region_docs is None or len(region_docs) == 0):
                 continue
 
-            for region_doc in region_docs:
-                print(region_doc.__dict__)
-                region_id = getattr(region_doc, "region_id")
-                region_name = getattr(region_doc, "region_name")
+            entries.extend([([gene], [disease], cls.get_criteria_dict(getattr(region_doc, "region_id"),
+                                                                      getattr(region_doc, "region_name")))
+                            for region_doc in region_docs])
 
-                result_container_populated = cls.populate_container(region_id,
-                                                                    region_name,
-                                                                    fnotes=None, features=[gene],
-                                                                    diseases=[disease],
-                                                                    result_container=result_container)
-                result_container = result_container_populated
+        return cls.populate_container_bulk(entries, result_container=result_container)
 
-        return result_container
+    @classmethod
+    def prefetch_cand_gene_in_region(cls, hits, config=None):
+        ''' Prime the genes of a page of study hits. '''
+        cls.gene_docs.prime([gene for hit in hits for gene in (hit['_source'].get('genes') or [])])
 
     @classmethod
-    def tag_feature_to_disease(cls, feature_doc, section, config, result_container={}):
-
-        feature_class = cls.__name__
-        # Get class from globals and create an instance
-        m = globals()[feature_class]()
-        # Get the function (from the instance) that we need to call
-        func = getattr(m, section)
-        result_container_ = func(feature_doc, section, config, result_container=result_container)
-        return result_container_
+    def clear_caches(cls):
+        ''' Forget the study hit and gene interval indices and the regions of study hits. '''
+        super().clear_caches()
+        cls.study_hit_indices.clear()
+        cls.hit_region_docs.clear()
+        cls.gene_join = None
+
+    @classmethod
+    def get_study_hit_index(cls, build):
+        ''' Get the interval index of the study hits for a build, loading it on first use.
+        @type  build: string
+        @param build: build number eg: '38'
+        '''
+        if build not in cls.study_hit_indices:
+            cls.study_hit_indices[build] = cls.load_study_hit_index(build)
+        return cls.study_hit_indices[build]
+
+    @classmethod
+    def load_study_hit_index(cls, build):
+        ''' Scroll the study hits once and index their build_info intervals for the build. '''
+        study_hit_index = IntervalIndex()
+
+        def add_hits(resp_json):
+            for hit in resp_json['hits']['hits']:
+                build_infos = hit['_source'].get('build_info', [])
+                if isinstance(build_infos, dict):
+                    build_infos = [build_infos]
+                hit_doc = None
+                for build_info in build_infos:
+                    if str(build_info.get('build')) != str(build):
+                        continue
+                    if hit_doc is None:
+                        hit_doc = Document(hit)
+                    study_hit_index.add(build_info['seqid'], build_info['start'], build_info['end'], hit_doc)
+
+        query = ElasticQuery(Query.match_all(), sources=['build_info', 'disease_locus', 'disease',
+                                                         'chr_band', 'species'])
+        ScanAndScroll.scan_and_scroll(ElasticSettings.idx('REGION', idx_type='STUDY_HITS'),
+                                      call_fun=add_hits, query=query)
+        logger.warning('Indexed ' + str(len(study_hit_index)) + ' study hit intervals for build ' + str(build))
+        return study_hit_index.index()
+
+    @classmethod
+    def hits_to_regions(cls, hit_docs):
+        ''' Get the region docs for a set of study hit docs, memoised by the hit ids. '''
+        hit_docs = list({hit_doc.doc_id(): hit_doc for hit_doc in hit_docs}.values())
+        if len(hit_docs) == 0:
+            return []
+        key = tuple(sorted(hit_doc.doc_id() for hit_doc in hit_docs))
+        if key not in cls.hit_region_docs:
+            cls.hit_region_docs[key] = utils.Region.hits_to_regions(hit_docs)
+        return cls.hit_region_docs[key]
 
     @classmethod
     def is_gene_in_mhc(cls, hit, section=None, config=None, result_container={}):
@@ -129,39 +198,56 @@ class GeneCriteria(Criteria):
 
     @classmethod
     def gene_in_region(cls, hit, section=None, config=None, result_container={}):
+        ''' Run gene_in_region for a single hit, as a page of one (see L{gene_in_region_page}). '''
+        return cls.gene_in_region_page([hit], section, config, result_container=result_container)
 
-        try:
-            padded_region_doc = utils.Region.pad_region_doc(Document(hit))
-        except:
-            logger.warn('Region padding error ')
-            return result_container
+    @classmethod
+    def gene_in_region_page(cls, hits, section=None, config=None, result_container={}):
+        ''' Page handler for gene_in_region (see L{Criteria.get_page_handler}), padding each region of the page
+        once and joining the padded regions against the genes in one pass. '''
+        padded_region_docs = []
+        for hit in hits:
+            try:
+                padded_region_docs.append(utils.Region.pad_region_doc(Document(hit)))
+            except (AttributeError, KeyError, TypeError) as e:
+                logger.warning('Region padding error ' + str(hit.get('_id')) + ' (' + repr(e) + ')')
+
+        queries = []
+        for (i, padded_region_doc) in enumerate(padded_region_docs):
+            build_info = getattr(padded_region_doc, "build_info")
+            queries.append((build_info['seqid'], build_info['start'], build_info['end'], i))
+        region_genes = [set() for _padded_region_doc in padded_region_docs]
+        for (i, gene) in cls.get_gene_join().join(queries):
+            region_genes[i].add(gene)
+
+        for (padded_region_doc, genes) in zip(padded_region_docs, region_genes):
+            result_container = cls.populate_container(getattr(padded_region_doc, "region_id"),
+                                                      getattr(padded_region_doc, "region_name"),
+                                                      fnotes=None, features=genes,
+                                                      diseases=getattr(padded_region_doc, "tags")['disease'],
+                                                      result_container=result_container)
+        return result_container
 
-        # 'build_info': {'end': 22411939, 'seqid': '1', 'build': 38, 'start': 22326008}, 'region_id': '1p36.12_008'}
-        region_id = getattr(padded_region_doc, "region_id")
-        region_name = getattr(padded_region_doc, "region_name")
-        build_info = getattr(padded_region_doc, "build_info")
-        diseases = getattr(padded_region_doc, "tags")['disease']
-        seqid = build_info['seqid']
-        start = build_info['start']
-        end = build_info['end']
-
-        gene_index = ElasticSettings.idx('GENE', idx_type='GENE')
-        elastic = Search.range_overlap_query(seqid=seqid, start_range=start, end_range=end,
-                                             idx=gene_index, field_list=['start', 'stop', '_id'],
-                                             seqid_param="chromosome",
-                                             end_param="stop", size=10000)
-        result_docs = elastic.search().docs
-
-        genes = set()
-        for doc in result_docs:
-            genes.add(doc.doc_id())
-
-        result_container_populated = cls.populate_container(region_id,
-                                                            region_name,
-                                                            fnotes=None, features=genes,
-                                                            diseases=diseases,
-                                                            result_container=result_container)
-        return result_container_populated
+    @classmethod
+    def get_gene_join(cls):
+        ''' Get the overlap join against the gene intervals, loading the genes with one scroll on first use. '''
+        if cls.gene_join is None:
+            gene_intervals = []
+
+            def add_genes(resp_json):
+                for hit in resp_json['hits']['hits']:
+                    gene_doc = hit['_source']
+                    if gene_doc.get('chromosome') is None or gene_doc.get('start') is None or \
+                            gene_doc.get('stop') is None:
+                        continue
+                    gene_intervals.append((gene_doc['chromosome'], gene_doc['start'], gene_doc['stop'], hit['_id']))
+
+            query = ElasticQuery(Query.match_all(), sources=['chromosome', 'start', 'stop'])
+            ScanAndScroll.scan_and_scroll(ElasticSettings.idx('GENE', idx_type='GENE'), call_fun=add_genes,
+                                          query=query)
+            cls.gene_join = IntervalJoin(gene_intervals)
+            logger.warning('Indexed ' + str(len(cls.gene_join)) + ' gene intervals')
+        return cls.gene_join
 
     @classmethod
     def exonic_index_snp_in_gene(cls, hit, section=None, config=None, result_container={}):
@@ -192,59 +278,14 @@ class GeneCriteria(Criteria):
         if disease_loci == 'tbc':
             return result_container
 
-        # get marker info and gene info from function info dbsp
-        # get marker doc
-        query = ElasticQuery(BoolQuery(must_arr=[Query.term("id", marker)]), sources=['id', 'info'])
-        elastic = Search(search_query=query, idx=ElasticSettings.idx('MARKER', 'MARKER'), size=1)
-        docs = elastic.search().docs
-        marker_doc = None
-
-        if docs is not None and len(docs) > 0:
-            marker_doc = elastic.search().docs[0]
-
-        if marker_doc is None:
-            return result_container
-
-        from marker.templatetags.marker_tags import marker_functional_info
-        from marker.templatetags.marker_tags import gene_info
-
-        ''' Retrieve functional information from bitfield in the INFO column.
-        ftp://ftp.ncbi.nlm.nih.gov/snp/specs/dbSNP_BitField_latest.pdf
-
-        ('has synonymous', True), ('has reference', True), ('has stop gain', False),
-        ('has non-synonymous missense', False), ('has non-synonymous frameshift', False), ('has stop loss', False)])
-        '''
-        functional_info = marker_functional_info(marker_doc)
-        # print(functional_info)
-
-        is_in_exon = False
-
-        if functional_info['has non-synonymous missense'] or\
-            functional_info['has synonymous'] or functional_info['has non-synonymous frameshift'] or\
-            functional_info['has reference'] or functional_info['has stop gain'] or\
-                functional_info['has stop loss']:
-                is_in_exon = True
-
-        # gene_symbols = []
-        if is_in_exon:
-            gene_ids = gene_info(marker_doc)
-            ensembl_gene_ids = gene_ids.values()
-#             gene_symbols.extend(list(gene_ids.keys()))
-#             print(ensembl_gene_ids)
-#             for gene in gene_symbols:
-#                 print('^^^\t'+gene)
-        else:
+        ensembl_gene_ids = cls.marker_exonic_genes.load(marker)
+        if ensembl_gene_ids is None:
             return result_container
 
         dil_study_id = feature_doc['dil_study_id']
         fnotes = None
         if dil_study_id:
-            query = ElasticQuery(Query.ids([dil_study_id]))
-            elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-            study_doc = elastic.search().docs[0]
-            author = getattr(study_doc, 'authors')[0]
-            first_author = author['name'] + ' ' + author['initials']
-            fnotes = {'linkid': dil_study_id, 'linkname': first_author}
+            fnotes = {'linkid': dil_study_id, 'linkname': cls.get_first_author(dil_study_id)}
 
         result_container_populated = cls.populate_container(marker,
                                                             marker,
@@ -254,6 +295,13 @@ class GeneCriteria(Criteria):
 
         return result_container_populated
 
+    @classmethod
+    def prefetch_exonic_index_snp_in_gene(cls, hits, config=None):
+        ''' Prime the markers and studies of a page of study hits. '''
+        feature_docs = [hit['_source'] for hit in hits]
+        cls.marker_exonic_genes.prime([feature_doc.get('marker') for feature_doc in feature_docs])
+        cls.study_authors.prime([feature_doc.get('dil_study_id') for feature_doc in feature_docs])
+
     @classmethod
     def fetch_disease_locus(cls, hits_docs):
 
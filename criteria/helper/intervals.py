@@ -0,0 +1,137 @@
+from bisect import bisect_right
+import logging
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class IntervalIndex():
+    ''' In memory index of (seqid, start, end) intervals for overlap lookups. The intervals of each seqid are
+    sorted by start; an overlap lookup bisects to the last interval starting before the end of the query and
+    scans back only as far as the longest interval on the seqid. Intervals are closed, so intervals touching
+    at a position overlap, as with the elastic range queries in L{Criteria.fetch_overlapping_features}. '''
+
+    def __init__(self):
+        self.intervals = {}
+        self.starts = {}
+        self.max_length = {}
+
+    def __len__(self):
+        return sum(len(intervals) for intervals in self.intervals.values())
+
+    def add(self, seqid, start, end, item):
+        ''' Add an interval and the item it is for. index has to be called after the intervals are added. '''
+        self.intervals.setdefault(str(seqid), []).append((int(start), int(end), item))
+
+    def index(self):
+        ''' Sort the intervals of each seqid ready for overlap lookups. '''
+        for seqid, intervals in self.intervals.items():
+            intervals.sort(key=lambda interval: (interval[0], interval[1]))
+            self.starts[seqid] = [start for (start, _end, _item) in intervals]
+            self.max_length[seqid] = max(end - start for (start, end, _item) in intervals)
+        return self
+
+    def overlaps(self, seqid, start, end):
+        ''' Get the items of the intervals overlapping start-end on seqid, in start order. '''
+        seqid = str(seqid)
+        if seqid not in self.starts:
+            return []
+        start = int(start)
+        end = int(end)
+        intervals = self.intervals[seqid]
+        starts = self.starts[seqid]
+
+        # intervals starting after end do not overlap, nor do those starting before start - max_length
+        hi = bisect_right(starts, end)
+        lo = bisect_right(starts, start - self.max_length[seqid] - 1)
+        return [item for (_start, interval_end, item) in intervals[lo:hi] if interval_end >= start]
+
+
+class IntervalJoin():
+    ''' Overlap join of query intervals against a set of target intervals, e.g. padded regions against all the
+    genes. The targets of each seqid are held as start and end arrays sorted by start; the queries of a seqid are
+    joined in one pass with searchsorted for the candidate target range of every query, and a vectorised end
+    check of the expanded candidates. Without numpy the join falls back to an L{IntervalIndex} lookup per
+    query. Intervals are closed. '''
+
+    def __init__(self, targets):
+        '''
+        @type  targets: iterable
+        @param targets: target (seqid, start, end, target_id) records
+        '''
+        if np is None:
+            logger.warning('numpy is not installed (see the numpy extra), '
+                           'IntervalJoin falls back to an IntervalIndex lookup per query')
+            self.interval_index = IntervalIndex()
+            for (seqid, start, end, target_id) in targets:
+                self.interval_index.add(seqid, start, end, target_id)
+            self.interval_index.index()
+            return
+
+        by_seqid = {}
+        for (seqid, start, end, target_id) in targets:
+            by_seqid.setdefault(str(seqid), []).append((int(start), int(end), target_id))
+
+        self.targets = {}
+        for seqid, intervals in by_seqid.items():
+            intervals.sort(key=lambda interval: (interval[0], interval[1]))
+            starts = np.array([start for (start, _end, _target_id) in intervals], dtype=np.int64)
+            ends = np.array([end for (_start, end, _target_id) in intervals], dtype=np.int64)
+            target_ids = [target_id for (_start, _end, target_id) in intervals]
+            self.targets[seqid] = (starts, ends, target_ids, int((ends - starts).max()))
+
+    def __len__(self):
+        if np is None:
+            return len(self.interval_index)
+        return sum(len(target_ids) for (_starts, _ends, target_ids, _max_length) in self.targets.values())
+
+    def join(self, queries):
+        ''' Get the overlapping (query_id, target_id) pairs, ordered by query (in the order given) and then by
+        target start.
+        @type  queries: iterable
+        @param queries: query (seqid, start, end, query_id) records
+        '''
+        queries = list(queries)
+        if np is None:
+            return [(query_id, target_id) for (seqid, start, end, query_id) in queries
+                    for target_id in self.interval_index.overlaps(seqid, start, end)]
+
+        by_seqid = {}
+        for pos, (seqid, start, end, _query_id) in enumerate(queries):
+            by_seqid.setdefault(str(seqid), []).append((pos, int(start), int(end)))
+
+        query_pos = []
+        target_ids = []
+        for seqid, seqid_queries in by_seqid.items():
+            if seqid not in self.targets:
+                continue
+            (starts, ends, seqid_target_ids, max_length) = self.targets[seqid]
+            positions = np.array([pos for (pos, _start, _end) in seqid_queries], dtype=np.int64)
+            qstarts = np.array([start for (_pos, start, _end) in seqid_queries], dtype=np.int64)
+            qends = np.array([end for (_pos, _start, end) in seqid_queries], dtype=np.int64)
+
+            # candidates start no later than the query end and no earlier than the query start - max_length
+            hi = np.searchsorted(starts, qends, side='right')
+            lo = np.minimum(np.searchsorted(starts, qstarts - max_length, side='left'), hi)
+            counts = hi - lo
+            total = int(counts.sum())
+            if total == 0:
+                continue
+
+            query_idx = np.repeat(np.arange(len(seqid_queries)), counts)
+            offsets = np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = np.arange(total) - offsets + lo[query_idx]
+            overlap = ends[candidates] >= qstarts[query_idx]
+
+            query_pos.append(positions[query_idx[overlap]])
+            target_ids.extend(seqid_target_ids[i] for i in candidates[overlap].tolist())
+
+        if len(query_pos) == 0:
+            return []
+        query_pos = np.concatenate(query_pos)
+        order = np.argsort(query_pos, kind='stable')
+        return [(queries[query_pos[i]][3], target_ids[i]) for i in order.tolist()]
@@ -0,0 +1,118 @@
+import json
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class LDCache():
+    ''' Persistent SQLite cache of ld_run results, keyed by (dataset, seqid, marker, rsq) and stamped with the
+    version of the reference panel so that results from another panel are never returned. Only the partner list
+    (ld['ld']) is stored. The number of lookups that hit and miss is recorded. When there are more than
+    max_entries results, the least recently used are evicted. The access times of hits are kept in memory and
+    written in batches (and before an eviction or close) rather than with a commit per hit. '''
+
+    # how often (in puts) the size is checked against max_entries, (in lookups) the stats are logged and
+    # (in hits) the access times are written
+    EVICT_EVERY = 1000
+    LOG_EVERY = 10000
+    ACCESSED_EVERY = 1000
+
+    def __init__(self, path, panel_version='1', max_entries=2000000):
+        '''
+        @type  path: string
+        @param path: path of the SQLite database file
+        @type  panel_version: string
+        @keyword panel_version: version of the reference panel the LD is calculated from
+        @type  max_entries: int
+        @keyword max_entries: maximum number of results kept
+        '''
+        self.path = path
+        self.panel_version = str(panel_version)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.accessed = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # WAL so that the processes of a sliced build can read while another writes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS ld (dataset TEXT, seqid TEXT, marker TEXT, rsq REAL, '
+                              'panel_version TEXT, ld TEXT, accessed INTEGER, '
+                              'PRIMARY KEY (dataset, seqid, marker, rsq, panel_version))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS ld_accessed ON ld (accessed)')
+        self.clock = self.conn.execute('SELECT COALESCE(MAX(accessed), 0) FROM ld').fetchone()[0]
+
+    def get(self, dataset, seqid, marker, rsq):
+        ''' Get the cached partner list, or None if it is not cached. '''
+        key = (dataset, str(seqid), marker, float(rsq), self.panel_version)
+        with self.lock:
+            row = self.conn.execute('SELECT ld FROM ld WHERE dataset=? AND seqid=? AND marker=? AND rsq=? AND '
+                                    'panel_version=?', key).fetchone()
+            if (self.hits + self.misses + 1) % self.LOG_EVERY == 0:
+                self.log_stats()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.accessed[key] = self.clock
+            if self.hits % self.ACCESSED_EVERY == 0:
+                self._write_accessed()
+            return json.loads(row[0])
+
+    def put(self, dataset, seqid, marker, rsq, partners):
+        ''' Cache the partner list of a marker. '''
+        key = (dataset, str(seqid), marker, float(rsq), self.panel_version)
+        with self.lock:
+            self.clock += 1
+            self.puts += 1
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO ld VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  key + (json.dumps(partners), self.clock))
+            if self.puts % self.EVICT_EVERY == 0:
+                self._evict()
+
+    def evict(self):
+        ''' Remove the least recently used results over max_entries. '''
+        with self.lock:
+            self._evict()
+
+    def _write_accessed(self):
+        ''' Write the access times of the hits since the last write. '''
+        if len(self.accessed) == 0:
+            return
+        with self.conn:
+            self.conn.executemany('UPDATE ld SET accessed=? WHERE dataset=? AND seqid=? AND marker=? AND rsq=? AND '
+                                  'panel_version=?', [(clock,) + key for (key, clock) in self.accessed.items()])
+        self.accessed.clear()
+
+    def _evict(self):
+        self._write_accessed()
+        nentries = self.conn.execute('SELECT COUNT(*) FROM ld').fetchone()[0]
+        if nentries <= self.max_entries:
+            return
+        with self.conn:
+            self.conn.execute('DELETE FROM ld WHERE rowid IN (SELECT rowid FROM ld ORDER BY accessed LIMIT ?)',
+                              (nentries - self.max_entries,))
+        logger.warning('LD cache evicted ' + str(nentries - self.max_entries) + ' results')
+
+    def hit_ratio(self):
+        ''' Fraction of the lookups found in the cache. '''
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def log_stats(self):
+        logger.warning('LD cache ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses (hit ratio ' +
+                       '{:.2f}'.format(self.hit_ratio()) + ')')
+
+    def close(self):
+        ''' Write the access times, evict over max_entries, log the hit/miss stats and close the database. '''
+        self.evict()
+        self.log_stats()
+        self.conn.close()
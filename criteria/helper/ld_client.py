@@ -0,0 +1,131 @@
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+import pyRserve
+
+
+logger = logging.getLogger(__name__)
+
+
+class LDClient():
+    ''' LD client with a pool of persistent Rserve connections. Connections are opened when first needed, up to
+    pool_size, and are reused for the ld_run calls instead of connecting for each call. ld_many dispatches calls
+    concurrently from a thread pool, one call per connection at a time. A connection that fails is closed and
+    replaced, and the call is retried once on a new connection. With an L{LDCache} the partner lists are looked up
+    in the cache before calling Rserve, and the results of the calls are cached (errors are not). '''
+
+    def __init__(self, host=None, port=None, pool_size=None, connect_fun=None, cache=None):
+        '''
+        @type  host: string
+        @keyword host: Rserve host (default: settings.RSERVE HOST)
+        @type  port: int
+        @keyword port: Rserve port (default: settings.RSERVE PORT)
+        @type  pool_size: int
+        @keyword pool_size: maximum number of connections (default: settings.RSERVE POOL_SIZE or 4)
+        @type  connect_fun: function
+        @keyword connect_fun: function called with host and port to open a connection (default: pyRserve.connect)
+        @type  cache: LDCache
+        @keyword cache: cache of the ld_run partner lists
+        '''
+        rserve = getattr(settings, 'RSERVE', {})
+        self.host = host if host is not None else rserve.get('HOST')
+        self.port = port if port is not None else rserve.get('PORT')
+        self.pool_size = pool_size if pool_size is not None else int(rserve.get('POOL_SIZE', 4))
+        self.connect_fun = connect_fun if connect_fun is not None else pyRserve.connect
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.nconnections = 0
+        self.calls = 0
+        self.cache = cache
+
+    def ld(self, dataset, seqid, marker, rsq=0.8, dprime=0):
+        ''' Run ld_run for a marker.
+        @return: the parsed ld_run result, a dict with the partner markers in 'ld' or an 'error'
+        '''
+        # the cache key has no dprime, so only the dprime=0 calls made by the criteria are cached
+        use_cache = self.cache is not None and dprime == 0
+        if use_cache:
+            partners = self.cache.get(dataset, seqid, marker, rsq)
+            if partners is not None:
+                return {'ld': partners}
+
+        try:
+            ld = self._ld_run(dataset, seqid, marker, rsq, dprime)
+        except Exception as e:
+            logger.warning('ld_run ' + marker + ' failed (' + repr(e) + '), retrying on a new connection')
+            ld = self._ld_run(dataset, seqid, marker, rsq, dprime)
+
+        if use_cache and 'error' not in ld:
+            self.cache.put(dataset, seqid, marker, rsq, ld.get('ld') or [])
+        return ld
+
+    def ld_many(self, ld_args, rsq=0.8, dprime=0):
+        ''' Run ld_run concurrently for a list of (dataset, seqid, marker).
+        @return: list of the parsed ld_run results, in the order of ld_args
+        '''
+        if len(ld_args) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(ld_args))) as executor:
+            return list(executor.map(lambda args: self.ld(*args, rsq=rsq, dprime=dprime), ld_args))
+
+    def close(self):
+        ''' Close the idle connections and the cache. '''
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _ld_run(self, dataset, seqid, marker, rsq, dprime):
+        conn = self._acquire()
+        try:
+            ld_str = conn.r.ld_run(dataset, seqid, marker, dprime=dprime, rsq=rsq)
+        except Exception:
+            self._discard(conn)
+            raise
+        self.idle.put(conn)
+        with self.lock:
+            self.calls += 1
+        ld_str = ld_str.replace('D.prime', 'dprime').replace('R.squared', 'rsquared')
+        return json.loads(str(ld_str))
+
+    def _acquire(self):
+        ''' Get an idle connection, opening one if there are fewer than pool_size, else wait for one. '''
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                can_connect = self.nconnections < self.pool_size
+                if can_connect:
+                    self.nconnections += 1
+            if can_connect:
+                break
+            try:
+                # checks again for a free slot if a failed connection was discarded meanwhile
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+        try:
+            return self.connect_fun(host=self.host, port=self.port)
+        except Exception:
+            with self.lock:
+                self.nconnections -= 1
+            raise
+
+    def _discard(self, conn):
+        with self.lock:
+            self.nconnections -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -1,12 +1,14 @@
 import logging
+import os
+import threading
 from builtins import classmethod
 from region import utils
 from elastic.result import Document
 from criteria.helper.criteria import Criteria
-from django.conf import settings
-import pyRserve
-from elastic.query import BoolQuery, Query
-from elastic.search import ElasticQuery, Search
+from criteria.helper.ld_client import LDClient
+from criteria.helper.ld_cache import LDCache
+from criteria.helper.data_loader import DataLoader
+from elastic.search import Search
 from elastic.elastic_settings import ElasticSettings
 import json
 from criteria.helper.criteria_manager import CriteriaManager
@@ -27,6 +29,28 @@ class MarkerCriteria(Criteria):
 
     FEATURE_TYPE = 'marker'
 
+    SOURCE_FIELDS = {
+        'rsq_with_index_snp': ['marker', 'disease', 'status', 'disease_locus', 'dil_study_id'],
+        'marker_is_gwas_significant_in_study': ['marker', 'disease', 'status', 'disease_locus', 'dil_study_id',
+                                                'p_values'],
+        'marker_is_gwas_significant_in_ic': ['marker', 'p_value'],
+    }
+
+    LD_DATASET = 'EUR'
+    LD_RSQ = 0.8
+
+    # LD client (per process), seqids of markers kept for the run and the ld results of the page (per thread,
+    # see Criteria.scan_pipelined)
+    ld_client = None
+    ld_client_pid = None
+    ld_client_lock = threading.Lock()
+    marker_seqids = DataLoader('MARKER', 'MARKER', field='id', sources=['id', 'seqid'],
+                               value_fun=lambda marker_doc: getattr(marker_doc, 'seqid'))
+    page = threading.local()
+    # (disease, study) from the _meta of the (index, type) of IC/GWAS statistics, and the indexes fetched
+    idx_type_meta = {}
+    meta_idxs = set()
+
     @classmethod
     def is_an_index_snp(cls, hit, section=None, config=None, result_container={}):
 
@@ -58,28 +82,10 @@ class MarkerCriteria(Criteria):
 
         region_docs = utils.Region.hits_to_regions([Document(hit)])
 
-        for region_doc in region_docs:
-                region_id = getattr(region_doc, "region_id")
-                region_name = getattr(region_doc, "region_name")
-
-                result_container_populated = cls.populate_container(region_id,
-                                                                    region_name,
-                                                                    fnotes=None, features=[marker],
-                                                                    diseases=[disease],
-                                                                    result_container=result_container)
-                result_container = result_container_populated
-
-        return result_container
-
-    @classmethod
-    def tag_feature_to_disease(cls, feature_doc, section, config, result_container={}):
-        feature_class = cls.__name__
-        # Get class from globals and create an instance
-        m = globals()[feature_class]()
-        # Get the function (from the instance) that we need to call
-        func = getattr(m, section)
-        result_container_ = func(feature_doc, section, config, result_container=result_container)
-        return result_container_
+        entries = [([marker], [disease], cls.get_criteria_dict(getattr(region_doc, "region_id"),
+                                                               getattr(region_doc, "region_name")))
+                   for region_doc in region_docs]
+        return cls.populate_container_bulk(entries, result_container=result_container)
 
     @classmethod
     def is_marker_in_mhc(cls, hit, section=None, config=None, result_container={}):
@@ -125,30 +131,14 @@ class MarkerCriteria(Criteria):
         # for the marker2 that is in ld with marker1, tag it with the right disease and studyid
         # query study index with the above dil_study_id to get the author name
 
-        query = ElasticQuery(BoolQuery(must_arr=[Query.term("id", marker1)]), sources=['seqid', 'start'])
-        elastic = Search(search_query=query, idx=ElasticSettings.idx('MARKER', 'MARKER'), size=1)
-        docs = elastic.search().docs
-        marker_doc = None
-
-        if docs is not None and len(docs) > 0:
-            marker_doc = elastic.search().docs[0]
-
-        if marker_doc is None:
+        seqid = cls.marker_seqids.load(marker1)
+        if seqid is None:
             return result_container
 
-        seqid = getattr(marker_doc, 'seqid')
-
-        rserve = getattr(settings, 'RSERVE')
-
-        conn = pyRserve.connect(host=rserve.get('HOST'), port=rserve.get('PORT'))
-        dataset = 'EUR'
-        rsq = 0.8
-
-        ld_str = conn.r.ld_run(dataset, seqid, marker1,
-                               dprime=0, rsq=rsq)
-        ld_str = ld_str.replace('D.prime', 'dprime').replace('R.squared', 'rsquared')
-        conn.close()
-        ld = json.loads(str(ld_str))
+        ld_args = (cls.LD_DATASET, seqid, marker1)
+        ld = getattr(cls.page, 'ld', {}).get(ld_args)
+        if ld is None:
+            ld = cls.get_ld_client(section, config).ld(*ld_args, rsq=cls.LD_RSQ)
 
         if 'error' in ld:
             global error_counter
@@ -166,12 +156,9 @@ class MarkerCriteria(Criteria):
         global all_counter
         all_counter = all_counter + len(marker_list)
 
-        query = ElasticQuery(Query.ids([dil_study_id]))
-        elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-        study_doc = elastic.search().docs[0]
-        author = getattr(study_doc, 'authors')[0]
-        first_author = author['name'] + ' ' + author['initials']
+        first_author = cls.get_first_author(dil_study_id)
 
+        entries = []
         for marker_dict in marker_list:
 
             marker2 = marker_dict['marker2']
@@ -181,15 +168,61 @@ class MarkerCriteria(Criteria):
             marker_name = marker1
 
             fnotes = {'linkdata': 'rsq', 'linkvalue': rsquared, 'linkid': dil_study_id, 'linkname': first_author}
+            entries.append(([marker2], [disease], cls.get_criteria_dict(marker_id, marker_name, fnotes)))
 
-            result_container_populated = cls.populate_container(marker_id,
-                                                                marker_name,
-                                                                fnotes=fnotes, features=[marker2],
-                                                                diseases=[disease],
-                                                                result_container=result_container)
-            result_container = result_container_populated
+        return cls.populate_container_bulk(entries, result_container=result_container)
+
+    @classmethod
+    def prefetch_rsq_with_index_snp(cls, hits, config=None):
+        ''' Run the ld_run calls for the index SNPs of a page concurrently over the pooled Rserve connections. '''
+        markers = set()
+        for hit in hits:
+            feature_doc = hit['_source']
+            if feature_doc.get('marker') is None or feature_doc.get('disease') is None or \
+                    feature_doc.get('status') != 'N' or feature_doc.get('disease_locus', '').lower() == 'tbc':
+                continue
+            markers.add(feature_doc['marker'])
+            cls.study_authors.prime([feature_doc.get('dil_study_id')])
+
+        markers = sorted(markers)
+        ld_args = [(cls.LD_DATASET, seqid, marker) for (marker, seqid) in zip(markers,
+                                                                             cls.marker_seqids.load_many(markers))
+                   if seqid is not None]
+        ld_client = cls.get_ld_client('rsq_with_index_snp', config)
+        cls.page.ld = dict(zip(ld_args, ld_client.ld_many(ld_args, rsq=cls.LD_RSQ)))
+
+    @classmethod
+    def prefetch_marker_is_gwas_significant_in_study(cls, hits, config=None):
+        ''' Prime the studies of a page of study hits. '''
+        cls.study_authors.prime([hit['_source'].get('dil_study_id') for hit in hits])
 
-        return result_container
+    @classmethod
+    def get_ld_client(cls, section=None, config=None):
+        ''' Get the LD client of this process, with its own pool of Rserve connections. If the section sets
+        ld_cache (path of the SQLite file) the LD results are cached there, stamped with ld_panel_version
+        and limited to ld_cache_max_entries results.
+        '''
+        with cls.ld_client_lock:
+            if cls.ld_client is None or cls.ld_client_pid != os.getpid():
+                cache = None
+                if config is not None and section is not None and config[section].get('ld_cache'):
+                    section_config = config[section]
+                    cache = LDCache(section_config.get('ld_cache'),
+                                    panel_version=section_config.get('ld_panel_version', '1'),
+                                    max_entries=int(section_config.get('ld_cache_max_entries', 2000000)))
+                cls.ld_client = LDClient(cache=cache)
+                cls.ld_client_pid = os.getpid()
+            return cls.ld_client
+
+    @classmethod
+    def close_connections(cls):
+        ''' Close the LD client of this process, its Rserve connections and LD cache. A client inherited from
+        the parent process is only dropped. '''
+        with cls.ld_client_lock:
+            if cls.ld_client is not None and cls.ld_client_pid == os.getpid():
+                cls.ld_client.close()
+            cls.ld_client = None
+            cls.ld_client_pid = None
 
     @classmethod
     def marker_is_gwas_significant_in_study(cls, hit, section=None, config=None, result_container={}):
@@ -244,11 +277,7 @@ class MarkerCriteria(Criteria):
 
         p_val_to_compare = float(p_val_to_compare)
         if p_val_to_compare < gw_sig_p:
-            query = ElasticQuery(Query.ids([dil_study_id]))
-            elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-            study_doc = elastic.search().docs[0]
-            author = getattr(study_doc, 'authors')[0]
-            first_author = author['name'] + ' ' + author['initials']
+            first_author = cls.get_first_author(dil_study_id)
             fnotes = {'linkdata': 'pval', 'linkvalue': p_val_to_compare,
                       'linkid': dil_study_id, 'linkname': first_author}
             result_container_populated = cls.populate_container(dil_study_id,
@@ -275,18 +304,7 @@ class MarkerCriteria(Criteria):
 
         # get meta data
         # studyid and diseaes
-        elastic_url = ElasticSettings.url()
-        meta_url = idx + '/' + idx_type + '/_mapping'
-        meta_response = Search.elastic_request(elastic_url, meta_url, is_post=False)
-
-        try:
-            elastic_meta = json.loads(meta_response.content.decode("utf-8"))
-            meta_info = elastic_meta[idx]['mappings'][idx_type]['_meta']
-            disease = meta_info['disease']
-            dil_study_id = meta_info['study']
-        except:
-            disease = None
-            dil_study_id = None
+        (disease, dil_study_id) = cls.get_idx_type_meta(idx, idx_type)
 
         marker = None
         if 'marker' in feature_doc:
@@ -307,11 +325,7 @@ class MarkerCriteria(Criteria):
                 first_author = 'NA'
                 dil_study_id = 'NA'
             else:
-                query = ElasticQuery(Query.ids([dil_study_id]))
-                elastic = Search(search_query=query, idx=ElasticSettings.idx('STUDY', 'STUDY'), size=1)
-                study_doc = elastic.search().docs[0]
-                author = getattr(study_doc, 'authors')[0]
-                first_author = author['name'] + ' ' + author['initials']
+                first_author = cls.get_first_author(dil_study_id)
 
             fnotes = {'linkdata': 'pval', 'linkvalue': p_val_to_compare,
                       'linkid': dil_study_id, 'linkname': first_author}
@@ -324,6 +338,51 @@ class MarkerCriteria(Criteria):
         else:
             return result_container
 
+    @classmethod
+    def clear_caches(cls):
+        ''' Forget the _meta of the IC/GWAS statistics indexes. '''
+        super().clear_caches()
+        cls.idx_type_meta.clear()
+        cls.meta_idxs.clear()
+
+    @classmethod
+    def prefetch_marker_is_gwas_significant_in_ic(cls, hits, config=None):
+        ''' Fetch the mappings of the indexes of a page not already fetched, in one request. '''
+        cls.fetch_idx_type_meta([hit['_index'] for hit in hits])
+
+    @classmethod
+    def get_idx_type_meta(cls, idx, idx_type):
+        ''' Get the (disease, study) from the _meta of an index type, or (None, None) if it has none. '''
+        cls.fetch_idx_type_meta([idx])
+        return cls.idx_type_meta.get((idx, idx_type), (None, None))
+
+    @classmethod
+    def fetch_idx_type_meta(cls, idxs):
+        ''' Fetch the mappings of all the types of the indexes not already fetched, and keep the (disease, study)
+        from the _meta of each type in idx_type_meta for the rest of the run. '''
+        idxs = set(idxs) - cls.meta_idxs
+        if len(idxs) == 0:
+            return
+
+        meta_url = ','.join(sorted(idxs)) + '/_mapping'
+        meta_response = Search.elastic_request(ElasticSettings.url(), meta_url, is_post=False)
+        cls.meta_idxs.update(idxs)
+        try:
+            elastic_meta = json.loads(meta_response.content.decode("utf-8"))
+        except ValueError:
+            logger.warning('Mappings not found for ' + meta_url)
+            return
+
+        for idx, idx_mappings in elastic_meta.items():
+            if not isinstance(idx_mappings, dict):
+                continue
+            for idx_type, mapping in idx_mappings.get('mappings', {}).items():
+                try:
+                    meta_info = mapping['_meta']
+                    cls.idx_type_meta[(idx, idx_type)] = (meta_info['disease'], meta_info['study'])
+                except KeyError:
+                    continue
+
     @classmethod
     def get_disease_tags(cls, feature_id, idx_type=None):
         'Function to get disease tags for a given feature_id...delegated to parent class Criteria. Returns disease docs'
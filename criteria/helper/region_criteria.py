@@ -1,10 +1,9 @@
 import logging
 from builtins import classmethod
 from criteria.helper.criteria import Criteria
-from elastic.search import ElasticQuery, Search
 from elastic.elastic_settings import ElasticSettings
-from elastic.query import Query
 from criteria.helper.criteria_manager import CriteriaManager
+from criteria.helper.data_loader import DataLoader
 
 
 logger = logging.getLogger(__name__)
@@ -20,15 +19,12 @@ class RegionCriteria(Criteria):
 
     FEATURE_TYPE = 'region'
 
-    @classmethod
-    def tag_feature_to_disease(cls, feature_doc, section, config, result_container={}):
-        feature_class = cls.__name__
-        # Get class from globals and create an instance
-        m = globals()[feature_class]()
-        # Get the function (from the instance) that we need to call
-        func = getattr(m, section)
-        result_container_ = func(feature_doc, section, config, result_container=result_container)
-        return result_container_
+    SOURCE_FIELDS = {
+        'is_region_for_disease': ['disease_loci', 'region_id'],
+    }
+
+    disease_locus_docs = DataLoader('REGION', 'DISEASE_LOCUS', sources=['hits'])
+    study_hit_docs = DataLoader('REGION', 'STUDY_HITS', sources=['disease', 'status', 'disease_locus'])
 
     @classmethod
     def is_region_in_mhc(cls, hit, section=None, config=None, result_container={}):
@@ -45,41 +41,50 @@ class RegionCriteria(Criteria):
         disease_loci = feature_doc['disease_loci']
         region_id = feature_doc['region_id']
 
+        cls.fetch_disease_loci(disease_loci)
+
         diseases = set()
         for disease_locus_id in disease_loci:
 
-            query = ElasticQuery(Query.ids([disease_locus_id]), sources=['hits'])
-            elastic = Search(query, idx=ElasticSettings.idx('REGION', idx_type='DISEASE_LOCUS'))
-            disease_locus_hits = elastic.search().docs
+            disease_locus_hit = cls.disease_locus_docs.load(disease_locus_id)
+            if disease_locus_hit is None:
+                continue
 
-            for disease_locus_hit in disease_locus_hits:
-                hits = getattr(disease_locus_hit, 'hits')
-                for hit in hits:
-                    query = ElasticQuery(Query.ids([hit]))
-                    elastic = Search(query, idx=ElasticSettings.idx('REGION', idx_type='STUDY_HITS'))
-                    hit_doc = elastic.search().docs[0]
+            hits = getattr(disease_locus_hit, 'hits')
+            for hit in hits:
+                hit_doc = cls.study_hit_docs.load(hit)
+                if hit_doc is None:
+                    logger.warning('study hit doc not found for ' + hit)
+                    continue
 
-                    disease = getattr(hit_doc, "disease")
-                    status = getattr(hit_doc, "status")
+                disease = getattr(hit_doc, "disease")
+                status = getattr(hit_doc, "status")
 
-                    if status != 'N':
-                        return result_container
+                if status != 'N':
+                    return result_container
 
-                    disease_loci = getattr(hit_doc, "disease_locus").lower()
+                disease_loci = getattr(hit_doc, "disease_locus").lower()
 
-                    if disease_loci == 'tbc':
-                        return result_container
+                if disease_loci == 'tbc':
+                    return result_container
 
-                    diseases.add(disease)
+                diseases.add(disease)
 
-        for disease in diseases:
+        entries = [([region_id], [disease], cls.get_criteria_dict(disease, disease)) for disease in diseases]
+        return cls.populate_container_bulk(entries, result_container=result_container_populated)
 
-            result_container_populated = cls.populate_container(disease,
-                                                                disease,
-                                                                fnotes=None, features=[region_id],
-                                                                diseases=[disease],
-                                                                result_container=result_container_populated)
-        return result_container_populated
+    @classmethod
+    def prefetch_is_region_for_disease(cls, hits, config=None):
+        ''' Load the disease loci of a page of regions, and their study hits, in a request each. '''
+        cls.fetch_disease_loci([disease_locus_id for hit in hits
+                                for disease_locus_id in hit['_source'].get('disease_loci', [])])
+
+    @classmethod
+    def fetch_disease_loci(cls, disease_locus_ids):
+        ''' Load the disease locus docs, and then the study hit docs they reference. '''
+        locus_docs = cls.disease_locus_docs.load_many(disease_locus_ids)
+        cls.study_hit_docs.load_many([hit_id for locus_doc in locus_docs if locus_doc is not None
+                                      for hit_id in getattr(locus_doc, 'hits')])
 
     @classmethod
     def get_disease_tags(cls, feature_id, idx_type=None):
@@ -0,0 +1,202 @@
+from array import array
+import heapq
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+def criteria_key(criteria_dict):
+    ''' Hashable (fid, fname, fnotes) key of a criteria dict. '''
+    fnotes = criteria_dict.get('fnotes')
+    if fnotes:
+        try:
+            fnotes = frozenset(fnotes.items())
+        except TypeError:
+            fnotes = json.dumps(fnotes, sort_keys=True)
+    else:
+        fnotes = None
+    return (criteria_dict.get('fid'), criteria_dict.get('fname'), fnotes)
+
+
+class CriteriaList(list):
+    ''' List of the criteria dicts tagged to a disease, with a hashed index of their (fid, fname, fnotes) keys so
+    that a duplicate is found in constant time. It compares equal to and serialises (json) as a plain list, so the
+    key index is dropped from the documents loaded. '''
+
+    def __init__(self, criteria_dicts=()):
+        super().__init__()
+        self.criteria_keys = set()
+        for criteria_dict in criteria_dicts:
+            self.add(criteria_dict)
+
+    def add(self, criteria_dict):
+        ''' Append the criteria dict if it is not already in the list. Returns True if it was added. '''
+        key = criteria_key(criteria_dict)
+        if key in self.criteria_keys:
+            return False
+        self.criteria_keys.add(key)
+        self.append(criteria_dict)
+        return True
+
+
+class SpillingResultContainer(dict):
+    ''' Result container (feature_id => {disease: [criteria_dict, ...]}) with a bounded number of features held
+    in memory. When check_budget finds more than max_features features, the features are written as
+    (feature_id, disease, criteria_dict) records to a run file sorted by feature_id and the container is
+    emptied. feature_items merges the runs feature by feature, giving the same criteria disease dicts as
+    building the whole result in memory. '''
+
+    def __init__(self, max_features=500000, spill_dir=None):
+        super().__init__()
+        self.max_features = max_features
+        self.spill_dir = spill_dir
+        self.run_files = []
+
+    def check_budget(self):
+        ''' Spill the features in memory to a run file if there are more than max_features. '''
+        if len(self) > self.max_features:
+            self.spill()
+
+    def spill(self):
+        ''' Write the features in memory to a sorted run file and empty the container. '''
+        if len(self) == 0:
+            return
+        (fd, run_file) = tempfile.mkstemp(prefix='criteria_run_', suffix='.json', dir=self.spill_dir)
+        with os.fdopen(fd, 'w') as run:
+            for feature_id in sorted((feature_id for feature_id in self if feature_id is not None)):
+                for disease, criteria_list in self[feature_id].items():
+                    for criteria_dict in criteria_list:
+                        run.write(json.dumps([feature_id, disease, criteria_dict]) + '\n')
+        logger.warning('Spilled ' + str(len(self)) + ' features to ' + run_file)
+        self.run_files.append(run_file)
+        self.clear()
+
+    def feature_items(self):
+        ''' Generator of (feature_id, criteria_disease_dict) over the spilled runs and the features in memory.
+        The run files are removed once all the features have been read. '''
+        if len(self.run_files) == 0:
+            yield from self.items()
+            return
+
+        self.spill()
+        runs = [open(run_file) for run_file in self.run_files]
+        try:
+            # records are merged by (feature id, run, line) so those of a feature stay in the order they were
+            # added (heapq.merge has no key argument before Python 3.5)
+            def decorate(run_idx, run):
+                for (line_no, line) in enumerate(run):
+                    rec = json.loads(line)
+                    yield (rec[0], run_idx, line_no, rec)
+
+            records = heapq.merge(*[decorate(run_idx, run) for (run_idx, run) in enumerate(runs)])
+            for feature_id, feature_records in itertools.groupby(records, key=lambda rec: rec[0]):
+                criteria_disease_dict = {}
+                for (_key, _run_idx, _line_no, (_feature_id, disease, criteria_dict)) in feature_records:
+                    if disease not in criteria_disease_dict:
+                        criteria_disease_dict[disease] = CriteriaList()
+                    criteria_disease_dict[disease].add(criteria_dict)
+                yield (feature_id, criteria_disease_dict)
+        finally:
+            for run in runs:
+                run.close()
+            self.remove_runs()
+
+    def remove_runs(self):
+        ''' Remove the run files from disk. '''
+        for run_file in self.run_files:
+            if os.path.exists(run_file):
+                os.remove(run_file)
+        self.run_files = []
+
+
+class ColumnarResultContainer():
+    ''' Compact result container. Feature ids are interned and disease codes are stored as small integers. Each
+    distinct criteria dict is stored once, and a feature holds an array of references to its (disease, criteria
+    dict) pairs. The {disease: [criteria_dict, ...]} rows are only built when feature_items streams them out, and
+    they are the same as those built by the dict container. '''
+
+    DISEASE_BITS = 16
+    # features with more entries than this get a set to find duplicates instead of scanning the array
+    MAX_SCAN = 32
+
+    def __init__(self):
+        self.feature_index = {}
+        self.feature_ids = []
+        self.feature_entries = []
+        self.feature_entry_sets = {}
+        self.disease_index = {}
+        self.diseases = []
+        self.criteria_index = {}
+        self.criteria_dicts = []
+
+    def __len__(self):
+        return len(self.feature_ids)
+
+    def __contains__(self, feature_id):
+        return feature_id in self.feature_index
+
+    def add(self, features, diseases, criteria_dict):
+        ''' Tag the criteria dict to each of the diseases of each of the features. '''
+        key = criteria_key(criteria_dict)
+        criteria_idx = self.criteria_index.get(key)
+        if criteria_idx is None:
+            criteria_idx = len(self.criteria_dicts)
+            self.criteria_index[key] = criteria_idx
+            self.criteria_dicts.append(criteria_dict)
+
+        refs = [(criteria_idx << self.DISEASE_BITS) | self._disease_idx(disease) for disease in diseases]
+        if len(refs) == 0:
+            return
+        for feature_id in features:
+            if feature_id is None:
+                continue
+            feature_idx = self._feature_idx(feature_id)
+            entries = self.feature_entries[feature_idx]
+            entry_set = self.feature_entry_sets.get(feature_idx)
+            for ref in refs:
+                if entry_set is not None:
+                    if ref in entry_set:
+                        continue
+                    entry_set.add(ref)
+                elif ref in entries:
+                    continue
+                entries.append(ref)
+            if entry_set is None and len(entries) > self.MAX_SCAN:
+                self.feature_entry_sets[feature_idx] = set(entries)
+
+    def feature_items(self):
+        ''' Generator of (feature_id, criteria_disease_dict), in the order the features were added. '''
+        mask = (1 << self.DISEASE_BITS) - 1
+        for feature_idx, feature_id in enumerate(self.feature_ids):
+            criteria_disease_dict = {}
+            for ref in self.feature_entries[feature_idx]:
+                disease = self.diseases[ref & mask]
+                if disease not in criteria_disease_dict:
+                    criteria_disease_dict[disease] = []
+                criteria_disease_dict[disease].append(self.criteria_dicts[ref >> self.DISEASE_BITS])
+            yield (feature_id, criteria_disease_dict)
+
+    def _feature_idx(self, feature_id):
+        feature_idx = self.feature_index.get(feature_id)
+        if feature_idx is None:
+            if isinstance(feature_id, str):
+                feature_id = sys.intern(feature_id)
+            feature_idx = len(self.feature_ids)
+            self.feature_index[feature_id] = feature_idx
+            self.feature_ids.append(feature_id)
+            self.feature_entries.append(array('Q'))
+        return feature_idx
+
+    def _disease_idx(self, disease):
+        disease_idx = self.disease_index.get(disease)
+        if disease_idx is None:
+            disease_idx = len(self.diseases)
+            self.disease_index[disease] = disease_idx
+            self.diseases.append(disease)
+        return disease_idx
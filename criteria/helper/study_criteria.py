@@ -18,6 +18,10 @@ class StudyCriteria(Criteria):
 
     FEATURE_TYPE = 'study'
 
+    SOURCE_FIELDS = {
+        'study_for_disease': ['diseases', 'study_id'],
+    }
+
     @classmethod
     def study_for_disease(cls, hit, section=None, config=None, result_container={}):
 
@@ -28,24 +32,16 @@ class StudyCriteria(Criteria):
         diseases = feature_doc['diseases']
         study_id = feature_doc['study_id']
 
-        for disease in diseases:
-
-            result_container_populated = cls.populate_container(disease,
-                                                                disease,
-                                                                fnotes=None, features=[study_id],
-                                                                diseases=[disease],
-                                                                result_container=result_container_populated)
-        return result_container_populated
+        entries = [([study_id], [disease], cls.get_criteria_dict(disease, disease)) for disease in diseases]
+        return cls.populate_container_bulk(entries, result_container=result_container_populated)
 
     @classmethod
-    def tag_feature_to_disease(cls, feature_doc, section, config, result_container={}):
-        feature_class = cls.__name__
-        # Get class from globals and create an instance
-        m = globals()[feature_class]()
-        # Get the function (from the instance) that we need to call
-        func = getattr(m, section)
-        result_container_ = func(feature_doc, section, config, result_container=result_container)
-        return result_container_
+    def study_for_disease_page(cls, hits, section=None, config=None, result_container={}):
+        ''' Page handler for study_for_disease (see L{Criteria.get_page_handler}), populating the container
+        with the studies of the page in one call. '''
+        entries = [([hit['_source']['study_id']], [disease], cls.get_criteria_dict(disease, disease))
+                   for hit in hits for disease in hit['_source']['diseases']]
+        return cls.populate_container_bulk(entries, result_container=result_container)
 
     @classmethod
     def get_disease_tags(cls, feature_id, idx_type=None):
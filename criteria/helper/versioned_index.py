@@ -0,0 +1,180 @@
+import json
+import logging
+import re
+import requests
+from elastic.elastic_settings import ElasticSettings
+from elastic.search import ElasticQuery, ScanAndScroll, Search
+from elastic.query import Query
+from criteria.helper.criteria import Criteria
+from criteria.helper.bulk import BulkEncoder, BulkLoader
+
+
+logger = logging.getLogger(__name__)
+
+
+class VersionedIndex():
+    ''' Blue/green builds of a criteria index. The criteria of a feature are built in to a new version of the
+    index (named <CRITERIA_IDX_FEATURE>_<build id>), the types that are not rebuilt being copied from the live
+    version. When the build is done the alias CRITERIA_IDX_<FEATURE> read by the API is switched to the new
+    version in one request, so readers never see a partly loaded index, and the versions over keep_versions
+    (in the DEFAULT section) are deleted. The live index name gives read-side caches the build to key on.
+    An index named CRITERIA_IDX_<FEATURE> (built before versioning) is only replaced by the alias if
+    replace_unversioned is set in the DEFAULT section, and only once its types have been copied to the new
+    version and their docs counted. '''
+
+    @classmethod
+    def is_versioned(cls, config):
+        ''' Builds are versioned if versioned_index is set in the DEFAULT section. '''
+        return config['DEFAULT'].get('versioned_index', 'false').lower() == 'true'
+
+    @classmethod
+    def is_replace_unversioned(cls, config):
+        ''' An index built before versioning is replaced if replace_unversioned is set in the DEFAULT section. '''
+        return config['DEFAULT'].get('replace_unversioned', 'false').lower() == 'true'
+
+    @classmethod
+    def start_build(cls, feature, sections, config):
+        ''' Start a build of the sections of a feature in to a new version of its criteria index. The criteria
+        index in the config is set to the new version and the types not rebuilt (or all of them for an
+        incremental build, which merges with the loaded docs) are copied to it from the live version.
+        @type  feature: string
+        @param feature: feature type, could be 'gene','region', 'marker' etc.,
+        @type  sections: list
+        @param sections: The sections in the criteria.ini file to be built
+        @type  config:  string
+        @param config: The config object initialized from criteria.ini.
+        @return: tuple of the alias, live index (or None) and new version of the index
+        @raise RuntimeError: if the live index was built before versioning and replace_unversioned is not set
+        '''
+        criteria_key = 'CRITERIA_IDX_' + feature.upper()
+        alias = config['DEFAULT'][criteria_key]
+        version_idx = alias + '_' + Criteria.get_build_meta()['build_id']
+        live_idx = cls.get_live_idx(alias)
+        if live_idx == alias and not cls.is_replace_unversioned(config):
+            raise RuntimeError(alias + ' was built before versioning, build with --replace-unversioned to copy '
+                               'it in to a version and replace it with an alias')
+
+        if live_idx is not None:
+            incremental = config['DEFAULT'].get('since', '').strip() != ''
+            idx_types = [idx_type for idx_type in cls.get_idx_types(live_idx)
+                         if idx_type in config and (incremental or idx_type not in sections)]
+            cls.copy_idx_types(live_idx, version_idx, idx_types, feature=feature, config=config)
+
+        config['DEFAULT'][criteria_key] = version_idx
+        logger.warning('Building ' + ','.join(sections) + ' in to ' + version_idx)
+        return (alias, live_idx, version_idx)
+
+    @classmethod
+    def finish_build(cls, alias, live_idx, version_idx, config):
+        ''' Refresh the new version, switch the alias to it and delete the versions over keep_versions. '''
+        Search.index_refresh(version_idx)
+        cls.switch_alias(alias, live_idx, version_idx)
+        keep_versions = int(config['DEFAULT'].get('keep_versions', 2))
+        for idx in cls.get_old_versions(alias, cls.get_idx_names(), version_idx, keep_versions):
+            logger.warning('Deleting old version ' + idx)
+            cls.delete_idx(idx)
+
+    @classmethod
+    def abort_build(cls, version_idx):
+        ''' Delete the new version of a build that failed, leaving the alias on the live version. '''
+        logger.warning('Build failed, deleting ' + version_idx)
+        cls.delete_idx(version_idx)
+
+    @classmethod
+    def get_live_idx(cls, alias):
+        ''' Get the index the alias is on, the alias itself if it is an index (built before versioning) or None
+        if there is neither. '''
+        resp = Search.elastic_request(ElasticSettings.url(), alias + '/_alias', is_post=False)
+        if resp.status_code != 200:
+            return None
+        idxs = sorted(json.loads(resp.content.decode("utf-8")).keys())
+        return idxs[-1] if len(idxs) > 0 else None
+
+    @classmethod
+    def get_idx_types(cls, idx):
+        ''' Get the types (criterias) in an index. '''
+        resp = Search.elastic_request(ElasticSettings.url(), idx + '/_mapping', is_post=False)
+        mappings = json.loads(resp.content.decode("utf-8"))
+        return list(mappings.get(idx, {}).get('mappings', {}).keys())
+
+    @classmethod
+    def get_count(cls, idx, idx_type):
+        ''' Get the number of docs of a type in an index. '''
+        resp = Search.elastic_request(ElasticSettings.url(), idx + '/' + idx_type + '/_count', is_post=False)
+        return json.loads(resp.content.decode("utf-8")).get('count', 0)
+
+    @classmethod
+    def get_idx_names(cls):
+        ''' Get the names of all the indexes. '''
+        resp = Search.elastic_request(ElasticSettings.url(), '_aliases', is_post=False)
+        return list(json.loads(resp.content.decode("utf-8")).keys())
+
+    @classmethod
+    def copy_idx_types(cls, from_idx, to_idx, idx_types, feature=None, config=None):
+        ''' Copy the docs of types (with their mapping and _meta) from one index to another (in bulk mode if
+        the feature is, see Criteria.start_bulk_mode), then refresh it and check the docs of each type are
+        all there.
+        @raise RuntimeError: if a type has fewer docs than it was copied from '''
+        for idx_type in idx_types:
+            meta = Criteria.get_meta_info(from_idx, idx_type) or {}
+            Criteria.create_criteria_mapping(to_idx, idx_type,
+                                             build_meta={k: v for k, v in meta.items() if k != 'desc'})
+            bulk_settings = None if config is None else Criteria.start_bulk_mode(to_idx, feature, config)
+            loader = BulkLoader(to_idx, idx_type)
+            encoder = BulkEncoder(to_idx, idx_type, flush_fun=loader.submit)
+
+            def copy_hits(resp_json):
+                for hit in resp_json['hits']['hits']:
+                    encoder.add(hit['_id'], hit['_source'])
+
+            try:
+                ScanAndScroll.scan_and_scroll(from_idx + '/' + idx_type, call_fun=copy_hits,
+                                              query=ElasticQuery(Query.match_all()))
+                encoder.close()
+            finally:
+                try:
+                    loader.close()
+                finally:
+                    Criteria.end_bulk_mode(to_idx, bulk_settings)
+            logger.warning('Copied ' + from_idx + ' ' + idx_type + ' to ' + to_idx)
+        if len(idx_types) > 0:
+            Search.index_refresh(to_idx)
+        for idx_type in idx_types:
+            (from_count, to_count) = (cls.get_count(from_idx, idx_type), cls.get_count(to_idx, idx_type))
+            if to_count < from_count:
+                raise RuntimeError('Copied ' + str(to_count) + ' of the ' + str(from_count) + ' ' + idx_type +
+                                   ' docs from ' + from_idx + ' to ' + to_idx)
+
+    @classmethod
+    def switch_alias(cls, alias, live_idx, version_idx):
+        ''' Move the alias from the live index to the new version in one request. An index with the name of
+        the alias (built before versioning, its types copied to the new version by start_build) is deleted
+        first, as an alias can not have the name of an index, and the alias is checked to be on the new
+        version afterwards.
+        @raise RuntimeError: if the alias could not be switched '''
+        actions = [{"add": {"index": version_idx, "alias": alias}}]
+        if live_idx == alias:
+            dropped = set(cls.get_idx_types(alias)) - set(cls.get_idx_types(version_idx))
+            if len(dropped) > 0:
+                logger.warning('Not in ' + version_idx + ' (not in criteria.ini): ' + ', '.join(sorted(dropped)))
+            logger.warning('Deleting ' + alias + ' (not versioned, copied to ' + version_idx + ') to create the alias')
+            cls.delete_idx(alias)
+        elif live_idx is not None:
+            actions.insert(0, {"remove": {"index": live_idx, "alias": alias}})
+        resp = Search.elastic_request(ElasticSettings.url(), '_aliases', data=json.dumps({"actions": actions}))
+        if resp.status_code != 200 or (live_idx == alias and cls.get_live_idx(alias) != version_idx):
+            raise RuntimeError('Failed to switch ' + alias + ' to ' + version_idx + ' (which has the criteria): ' +
+                               resp.content.decode("utf-8"))
+        logger.warning(alias + ' switched to ' + version_idx)
+
+    @classmethod
+    def get_old_versions(cls, alias, idx_names, live_idx, keep_versions):
+        ''' Get the versions of an index to delete, all but the keep_versions latest (always keeping the
+        live index). '''
+        version_re = re.compile('^' + re.escape(alias) + r'_\d{14}$')
+        versions = sorted(idx for idx in idx_names if version_re.match(idx) and idx != live_idx)
+        return versions[:max(len(versions) - max(keep_versions - 1, 0), 0)]
+
+    @classmethod
+    def delete_idx(cls, idx):
+        requests.delete(ElasticSettings.url() + '/' + idx)
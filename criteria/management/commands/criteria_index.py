@@ -1,5 +1,5 @@
 ''' Command line tool to manage downloads. '''
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from criteria.helper.criteria_manager import CriteriaManager
 
 
@@ -10,6 +10,10 @@ class Command(BaseCommand):
     ./manage.py criteria_index --feature gene --criteria cand_gene_in_study
     ./manage.py criteria_index --feature gene --test
     ./manage.py criteria_index --feature marker --criteria is_in_mhc
+    ./manage.py criteria_index --feature marker --workers 4
+    ./manage.py criteria_index --feature marker --criteria rsq_with_index_snp --slices 8
+    ./manage.py criteria_index --feature marker --shared-scan
+    ./manage.py criteria_index --feature marker --since last
     '''
     help = "Create criteria indexes(s)."
 
@@ -28,6 +32,30 @@ class Command(BaseCommand):
                             dest='test',
                             action='store_true',
                             help='Run in test mode')
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=1,
+                            help='Number of criterias to build in parallel [default: 1].')
+        parser.add_argument('--slices',
+                            dest='slices',
+                            type=int,
+                            help='Number of worker processes to process the source index of a criteria with '
+                                 '[default: slices in criteria.ini or 1].')
+        parser.add_argument('--shared-scan',
+                            dest='shared_scan',
+                            action='store_true',
+                            help='Build criterias reading the same source index from a single scroll')
+        parser.add_argument('--since',
+                            dest='since',
+                            help='Rebuild only the features of the source documents changed since a time '
+                                 '(e.g. 2016-05-20T10:30:00), build id (e.g. 20160520103000) or the last build '
+                                 '(last), for the criterias with a timestamp_field in criteria.ini.')
+        parser.add_argument('--replace-unversioned',
+                            dest='replace_unversioned',
+                            action='store_true',
+                            help='With versioned_index in criteria.ini, copy an index built before versioning in '
+                                 'to the first version and replace it with the alias.')
 
     def handle(self, *args, **options):
         criteria_manager = CriteriaManager()
@@ -47,4 +75,10 @@ class Command(BaseCommand):
         else:
             config_ = criteria_manager.get_criteria_config(ini_file='criteria.ini')
 
-        criteria_manager.process_criterias(feature=feature_, criteria=criteria_, config=config_, show=show_, test=test_)
+        failed = criteria_manager.process_criterias(feature=feature_, criteria=criteria_, config=config_, show=show_,
+                                                    test=test_, workers=options['workers'],
+                                                    slices=options['slices'], shared_scan=options['shared_scan'],
+                                                    since=options['since'],
+                                                    replace_unversioned=options['replace_unversioned'])
+        if not show_ and failed:
+            raise CommandError('Failed to build criteria: ' + ', '.join(sorted(failed)))
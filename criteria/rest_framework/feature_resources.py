@@ -63,7 +63,7 @@ class CriteriaFilterBackend(ElasticFilterBackend):
             criteria_list = idx_types.split(',')
             criteria_details_expanded = Criteria.add_meta_info(idx, criteria_list, criteria_details)
 
-            feature_details = self._get_feature_details(criteria_details_expanded)
+            feature_details = self._get_feature_details(criteria_details_expanded, idx)
 
             for criteria, details in feature_details.items():
                 print(criteria)
@@ -95,7 +95,9 @@ class CriteriaFilterBackend(ElasticFilterBackend):
             view.es_count = json_results['hits']['total']
             return results
 
-    def _get_feature_details(self, criteria_details_expanded):
+    def _get_feature_details(self, criteria_details_expanded, idx):
+        ''' The meta_info and link_info are keyed by idx, the index or alias searched, rather than by the
+        _index of the hits, which for an alias (see VersionedIndex) is the index it is on. '''
 
         feature_details = {}
         hits = criteria_details_expanded['hits']
@@ -104,13 +106,12 @@ class CriteriaFilterBackend(ElasticFilterBackend):
 
         for hit in hits:
             _source = hit['_source']
-            _index = hit['_index']
             _type = hit['_type']
             _id = hit['_id']
             _disease_tags = _source['disease_tags']
             _qid = _source['qid']
-            link_id_type = link_info[_index][_type]
-            _type_desc = meta_info[_index][_type]
+            link_id_type = link_info[idx][_type]
+            _type_desc = meta_info[idx][_type]
 
             for dis in _disease_tags:
                 fdetails = _source[dis]
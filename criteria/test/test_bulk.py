@@ -0,0 +1,73 @@
+from django.test import TestCase
+from criteria.helper.bulk import BulkEncoder, BulkLoader
+import json
+from unittest import mock
+
+
+class BulkEncoderTest(TestCase):
+    '''Test BulkEncoder'''
+
+    def test_flush_on_size(self):
+        payloads = []
+        encoder = BulkEncoder('pydgin_imb_criteria_gene', 'cand_gene_in_study', max_bytes=1000,
+                              flush_fun=lambda payload, ndocs: payloads.append((payload, ndocs)))
+        for i in range(10):
+            encoder.add('ENSG0000011080' + str(i), {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                                     'score': 10, 'disease_tags': ['T1D'],
+                                                     'qid': 'ENSG0000011080' + str(i)})
+        encoder.close()
+
+        self.assertTrue(len(payloads) > 1, 'Flushed more than once')
+        self.assertEqual(sum(ndocs for _payload, ndocs in payloads), 10, 'All docs flushed')
+        for payload, ndocs in payloads:
+            self.assertTrue(len(payload) <= 1000, 'Payload within max_bytes')
+            lines = payload.decode('utf-8').splitlines()
+            self.assertEqual(len(lines), ndocs * 2, 'Action and doc line per document')
+            self.assertEqual(json.loads(lines[0])['index']['_type'], 'cand_gene_in_study')
+        self.assertEqual([(len(payload), ndocs) for payload, ndocs in payloads], encoder.flushes,
+                         'Bytes and docs recorded per flush')
+
+
+class BulkLoaderTest(TestCase):
+    '''Test BulkLoader'''
+
+    def response(self, status_code, json_data):
+        resp = mock.Mock(status_code=status_code, content=json.dumps(json_data).encode('utf-8'))
+        resp.json.return_value = json_data
+        return resp
+
+    def test_retry_rejected_items(self):
+        payload = b'{"index": {"_id": "a"}}\n{"qid": "a"}\n{"index": {"_id": "b"}}\n{"qid": "b"}\n'
+        responses = [
+            self.response(200, {'errors': True, 'items': [{'index': {'_id': 'a', 'status': 201}},
+                                                          {'index': {'_id': 'b', 'status': 429}}]}),
+            self.response(200, {'errors': False, 'items': [{'index': {'_id': 'b', 'status': 201}}]})]
+
+        loader = BulkLoader('pydgin_imb_criteria_gene', 'cand_gene_in_study', workers=0, url='http://localhost')
+        with mock.patch('criteria.helper.bulk.time.sleep'), \
+                mock.patch('criteria.helper.bulk.Search.elastic_request', side_effect=responses) as elastic_request:
+            loader.submit(payload)
+        self.assertEqual(loader.failed, [], 'Rejected item loaded on retry')
+        self.assertEqual(elastic_request.call_args_list[0][0],
+                         ('http://localhost', 'pydgin_imb_criteria_gene/cand_gene_in_study/_bulk'),
+                         'Sent through the elastic request helper')
+        self.assertEqual(elastic_request.call_args_list[1][1]['data'], b'{"index": {"_id": "b"}}\n{"qid": "b"}\n',
+                         'Only the rejected item is resent')
+
+    def test_failed_items(self):
+        payload = b'{"index": {"_id": "a"}}\n{"qid": "a"}\n'
+        resp = self.response(200, {'errors': True, 'items': [{'index': {'_id': 'a', 'status': 400}}]})
+        loader = BulkLoader('pydgin_imb_criteria_gene', 'cand_gene_in_study', workers=0, url='http://localhost')
+        with mock.patch('criteria.helper.bulk.Search.elastic_request', return_value=resp):
+            loader.submit(payload)
+        self.assertEqual(len(loader.failed), 1, 'Item failed')
+        self.assertRaises(RuntimeError, loader.close)
+
+    def test_close_in_flight_exception(self):
+        loader = BulkLoader('pydgin_imb_criteria_gene', 'cand_gene_in_study', workers=0, url='http://localhost')
+        loader._failed('400')
+        with self.assertRaises(ValueError, msg='In flight exception not masked by the failed items'):
+            try:
+                raise ValueError('scroll failed')
+            finally:
+                loader.close()
@@ -1,6 +1,8 @@
 from django.test import TestCase
 from elastic.elastic_settings import ElasticSettings
+import json
 import os
+from unittest import mock
 import criteria
 from data_pipeline.utils import IniParser
 from criteria.helper.criteria import Criteria
@@ -77,6 +79,243 @@ class CriteriaTest(TestCase):
         match_all_query_dict = match_all_query.__dict__
         self.assertTrue('match_all' in str(match_all_query_dict))
 
+    def test_group_by_source(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        sections = ['is_gene_in_mhc', 'cand_gene_in_region', 'cand_gene_in_study', 'exonic_index_snp_in_gene']
+        groups = Criteria.group_by_source(sections, config)
+        self.assertIn(['cand_gene_in_region', 'exonic_index_snp_in_gene'], groups, 'study hits criterias grouped')
+        self.assertIn(['is_gene_in_mhc'], groups, 'mhc range query not shared')
+
+    def test_get_source_fields(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        self.assertEqual(Criteria.get_source_fields('is_gene_in_mhc', config), ['start', 'stop', 'id'],
+                         'source_fields in the section')
+        self.assertEqual(Criteria.get_source_fields('exonic_index_snp_in_gene', config),
+                         ['marker', 'disease', 'status', 'disease_locus', 'dil_study_id'], 'declared SOURCE_FIELDS')
+        self.assertEqual(Criteria.get_source_fields('gene_in_region', config), [], 'no projection')
+        query = Criteria.get_elastic_query('exonic_index_snp_in_gene', config)
+        self.assertEqual(query.query['_source'], ['marker', 'disease', 'status', 'disease_locus', 'dil_study_id'])
+
+        config['exonic_index_snp_in_gene']['debug_source_fields'] = 'true'
+        self.assertEqual(Criteria.get_source_fields('exonic_index_snp_in_gene', config), [], 'debug: no projection')
+        watch_source_fields = Criteria.get_source_watcher('exonic_index_snp_in_gene', config)
+        hit = watch_source_fields({'_id': '1', '_source': {'marker': 'rs2476601', 'genes': ['ENSG00000134242']}})
+        with self.assertLogs('criteria.helper.criteria', level='WARNING') as logs:
+            self.assertEqual(hit['_source']['marker'], 'rs2476601')
+            self.assertEqual(hit['_source']['genes'], ['ENSG00000134242'])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('genes', logs.output[0])
+        self.assertIsNone(Criteria.get_source_watcher('cand_gene_in_region', config))
+
+    def test_get_query_filters(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        self.assertIsNone(Criteria.get_query_filters('cand_gene_in_study', config), 'No query_filters')
+
+        bool_query = Criteria.get_query_filters('cand_gene_in_region', config)
+        self.assertEqual(bool_query.query['bool']['must'][0],
+                         {'query_string': {'query': '"N"', 'fields': ['status']}})
+        self.assertEqual(bool_query.query['bool']['must_not'][0],
+                         {'query_string': {'query': '"tbc"', 'fields': ['disease_locus']}})
+
+        query = Criteria.get_elastic_query('cand_gene_in_region', config)
+        self.assertIn('filtered', str(query.query), 'Filters in the query')
+
+        config['cand_gene_in_region']['query_filters'] = 'p_value<5e-8'
+        bool_query = Criteria.get_query_filters('cand_gene_in_region', config)
+        self.assertIn('5e-08', str(bool_query.query))
+
+        config['cand_gene_in_region']['query_filters'] = 'p_value~1'
+        self.assertRaises(ValueError, Criteria.get_query_filters, 'cand_gene_in_region', config)
+
+    def test_scan_pipelined(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        pages = [[{'_id': 'hit' + str(page) + '_' + str(i), '_source': {'disease': ['T1D', 'MS'][i % 2]}}
+                  for i in range(10)] for page in range(20)]
+
+        class PageCriteria(Criteria):
+            @classmethod
+            def cand_gene_in_region(cls, hit, section=None, config=None, result_container={}):
+                fid = hit['_id'].split('_')[0]
+                return cls.populate_container(fid, fid, features=['feature' + hit['_id'][-1]],
+                                              diseases=[hit['_source']['disease']],
+                                              result_container=result_container)
+
+        def scan_and_scroll(idx, call_fun=None, query=None):
+            for hits in pages:
+                call_fun({'hits': {'hits': hits}})
+
+        expected = {}
+        for hits in pages:
+            for hit in hits:
+                expected = PageCriteria.tag_feature_to_disease(hit, 'cand_gene_in_region', config,
+                                                               result_container=expected)
+
+        with mock.patch('criteria.helper.criteria.ScanAndScroll.scan_and_scroll', side_effect=scan_and_scroll):
+            result_container = Criteria.scan_pipelined('idx', None, 'cand_gene_in_region', config, PageCriteria,
+                                                       4, queue_size=2)
+        self.assertEqual(expected, dict(Criteria.iter_result_container(result_container)),
+                         'Pipelined result as processed in order')
+
+    def test_scan_in_slices_daemon(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        pages = [[{'_id': 'hit' + str(page) + '_' + str(i), '_source': {}} for i in range(5)] for page in range(10)]
+
+        class SliceCriteria(Criteria):
+            @classmethod
+            def cand_gene_in_region(cls, hit, section=None, config=None, result_container={}):
+                return cls.populate_container(hit['_id'], hit['_id'], features=['feature' + hit['_id'][-1]],
+                                              diseases=['T1D'], result_container=result_container)
+
+        def scan_and_scroll(idx, call_fun=None, query=None):
+            for hits in pages:
+                call_fun({'hits': {'hits': hits}})
+
+        # a daemonic process (e.g. a pool worker) cannot start the slice processes so threads are used
+        with mock.patch('criteria.helper.criteria.ScanAndScroll.scan_and_scroll', side_effect=scan_and_scroll), \
+                mock.patch('multiprocessing.current_process', return_value=mock.Mock(daemon=True)):
+            result_container = Criteria.scan_in_slices('idx', None, 'cand_gene_in_region', config, SliceCriteria, 4)
+        results = dict(Criteria.iter_result_container(result_container))
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(len(results[feature_id]['T1D']) == 10 for feature_id in results), 'All hits processed')
+
+    def test_scan_in_slices_scroll_error(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+
+        class SliceCriteria(Criteria):
+            @classmethod
+            def cand_gene_in_region(cls, hit, section=None, config=None, result_container={}):
+                return cls.populate_container(hit['_id'], hit['_id'], features=[hit['_id']],
+                                              diseases=['T1D'], result_container=result_container)
+
+        def scan_and_scroll(idx, call_fun=None, query=None):
+            for page in range(5):
+                call_fun({'hits': {'hits': [{'_id': 'hit' + str(page) + '_' + str(i), '_source': {}}
+                                            for i in range(5)]}})
+            raise ConnectionError('scroll lost')
+
+        # the scroll error is raised once the slice workers have been collected and joined
+        with mock.patch('criteria.helper.criteria.ScanAndScroll.scan_and_scroll', side_effect=scan_and_scroll), \
+                mock.patch('multiprocessing.current_process', return_value=mock.Mock(daemon=True)), \
+                mock.patch.object(Criteria, 'collect_slices', wraps=Criteria.collect_slices) as collect_slices:
+            self.assertRaises(ConnectionError, Criteria.scan_in_slices, 'idx', None, 'cand_gene_in_region', config,
+                              SliceCriteria, 4)
+        (_result_queue, workers) = collect_slices.call_args[0]
+        self.assertFalse(any(worker.is_alive() for worker in workers), 'Slice workers joined')
+
+    def test_get_since(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        self.assertIsNone(Criteria.get_since('cand_gene_in_region', config), 'Full build')
+
+        config['DEFAULT']['since'] = '20160520103000'
+        self.assertIsNone(Criteria.get_since('cand_gene_in_region', config), 'Full build without timestamp_field')
+
+        config['cand_gene_in_region']['timestamp_field'] = 'last_modified'
+        self.assertEqual(Criteria.get_since('cand_gene_in_region', config), '2016-05-20T10:30:00')
+        config['DEFAULT']['since'] = '2016-05-20'
+        self.assertEqual(Criteria.get_since('cand_gene_in_region', config), '2016-05-20T00:00:00')
+
+        query = Criteria.get_elastic_query('cand_gene_in_region', config)
+        self.assertIn('last_modified', str(query.query), 'Source documents changed since')
+
+        config['DEFAULT']['since'] = 'yesterday'
+        self.assertRaises(ValueError, Criteria.get_since, 'cand_gene_in_region', config)
+
+        build_meta = Criteria.get_build_meta()
+        config['DEFAULT']['since'] = build_meta['build_id']
+        self.assertEqual(Criteria.get_since('cand_gene_in_region', config), build_meta['build_time'])
+
+    def test_merge_loaded_docs(self):
+        result_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None,
+                                                       ['ENSG00000110800', 'ENSG00000134242'], ['T1D'],
+                                                       result_container={})
+        loaded_doc = {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                      'MS': [{'fid': 'GDXHsS00005', 'fname': 'Cooper'}],
+                      'score': 20, 'disease_tags': ['T1D', 'MS'], 'qid': 'ENSG00000110800'}
+
+        def scan_and_scroll(idx, call_fun=None, query=None):
+            call_fun({'hits': {'hits': [{'_id': 'ENSG00000110800', '_source': loaded_doc}]}})
+
+        with mock.patch('criteria.helper.criteria.ScanAndScroll.scan_and_scroll', side_effect=scan_and_scroll):
+            merged = Criteria.merge_loaded_docs(result_container, 'idx', 'cand_gene_in_study')
+        expected_dict = {'ENSG00000110800': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                             'MS': [{'fid': 'GDXHsS00005', 'fname': 'Cooper'}]},
+                         'ENSG00000134242': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]}}
+        self.assertEqual(merged, expected_dict, 'Merged with the loaded criteria')
+
+    def test_bulk_mode(self):
+        config = IniParser().read_ini(MY_INI_FILE)
+        self.assertFalse(Criteria.is_bulk_mode('gene', config), 'Not in bulk mode')
+        self.assertIsNone(Criteria.start_bulk_mode('criteria_idx', 'gene', config), 'Settings not changed')
+        config['DEFAULT']['bulk_mode_gene'] = 'true'
+        config['DEFAULT']['force_merge_gene'] = '1'
+        self.assertTrue(Criteria.is_bulk_mode('gene', config), 'In bulk mode')
+
+        with mock.patch('criteria.helper.criteria.requests') as requests, \
+                mock.patch('criteria.helper.criteria.Search') as search:
+            requests.get.return_value = mock.Mock(status_code=200)
+            requests.get.return_value.json.return_value = \
+                {'criteria_idx_v1': {'settings': {'index': {'refresh_interval': '30s', 'number_of_replicas': '2'}}}}
+            requests.put.return_value = mock.Mock(status_code=200)
+            requests.post.return_value = mock.Mock(status_code=200)
+
+            bulk_settings = Criteria.start_bulk_mode('criteria_idx', 'gene', config)
+            self.assertIn('"refresh_interval": "-1"', requests.put.call_args[1]['data'], 'Refresh off')
+            self.assertEqual(bulk_settings, {'refresh_interval': '30s', 'number_of_replicas': 2},
+                             'Previous settings kept')
+
+            Criteria.end_bulk_mode('criteria_idx', bulk_settings)
+            self.assertEqual(json.loads(requests.put.call_args[1]['data']),
+                             {'index': {'refresh_interval': '30s', 'number_of_replicas': 2}}, 'Settings restored')
+            search.index_refresh.assert_called_once_with('criteria_idx')
+
+            # already in bulk mode, left to the load that turned it on
+            requests.put.reset_mock()
+            requests.get.return_value.json.return_value = \
+                {'criteria_idx_v1': {'settings': {'index': {'refresh_interval': '-1', 'number_of_replicas': '0'}}}}
+            self.assertIsNone(Criteria.start_bulk_mode('criteria_idx', 'gene', config))
+            self.assertFalse(requests.put.called)
+
+            Criteria.force_merge('gene', config)
+            idx = Criteria.get_criteria_idx('gene', config)
+            self.assertIn(idx + '/_optimize?max_num_segments=1', requests.post.call_args[0][0], 'Force merged')
+
+    def test_bulk_mode_restored(self):
+        ''' The settings are restored when the load fails. '''
+        config = IniParser().read_ini(MY_INI_FILE)
+        config['DEFAULT']['bulk_mode_gene'] = 'true'
+        bulk_settings = {'refresh_interval': '1s', 'number_of_replicas': 1}
+        with mock.patch.object(Criteria, 'create_criteria_mapping'), \
+                mock.patch.object(Criteria, 'start_bulk_mode', return_value=bulk_settings), \
+                mock.patch.object(Criteria, 'end_bulk_mode') as end_bulk_mode, \
+                mock.patch.object(Criteria, 'load_result_container', side_effect=RuntimeError('load failed')):
+            self.assertRaises(RuntimeError, Criteria.map_and_load, 'gene', 'cand_gene_in_study', config, {})
+            end_bulk_mode.assert_called_once_with(Criteria.get_criteria_idx('gene', config), bulk_settings)
+
+    def test_get_all_criteria_disease_tags_alias(self):
+        ''' Disease tags read through the alias of a versioned criteria index (see VersionedIndex). '''
+        alias = 'pydgin_imb_criteria_gene'
+        version_idx = alias + '_20160101000000'
+        hits = [{'_index': version_idx, '_type': 'cand_gene_in_study', '_id': 'ENSG00000134242',
+                 '_source': {'qid': 'ENSG00000134242', 'disease_tags': ['T1D']}},
+                {'_index': version_idx, '_type': 'gene_in_region', '_id': 'ENSG00000134242',
+                 '_source': {'qid': 'ENSG00000134242', 'disease_tags': ['T1D', 'MS']}}]
+        mappings = {version_idx: {'mappings': {'cand_gene_in_study': {'_meta': {'desc': 'Candidate gene'}},
+                                               'gene_in_region': {'_meta': {'desc': 'Gene in region'}}}}}
+        with mock.patch('criteria.helper.criteria.Search') as search, \
+                mock.patch('criteria.helper.criteria.ElasticQuery'), \
+                mock.patch('criteria.helper.criteria.Query'), \
+                mock.patch('criteria.helper.criteria.ElasticSettings'):
+            search.return_value.get_json_response.return_value = {'hits': {'hits': hits}}
+            search.elastic_request.return_value = mock.Mock(content=json.dumps(mappings).encode('utf-8'))
+            criteria_disease_tags = Criteria.get_all_criteria_disease_tags(['ENSG00000134242'], alias,
+                                                                           'cand_gene_in_study,gene_in_region')
+
+        disease_tags = criteria_disease_tags['ENSG00000134242']
+        self.assertEqual(disease_tags['cand_gene_in_study'], ['T1D'], 'Hits from the index the alias is on')
+        self.assertEqual(sorted(disease_tags['all']), ['MS', 'T1D'])
+        self.assertEqual(disease_tags['meta_info'], {'cand_gene_in_study': 'Candidate gene',
+                                                     'gene_in_region': 'Gene in region'}, 'Meta read through the alias')
+
     def test_get_criteria_dict(self):
 
         expected_dict = {'fid': 'GDXHsS00004', 'fname': 'Barrett'}
@@ -110,6 +349,31 @@ class CriteriaTest(TestCase):
                                  {'fname': 'Catfield', 'fid': 'GDXHsS00005'}]}
         self.assertEqual(criteria_disease_dict, expected_dict, 'Dict as expected after adding diseases')
 
+    def test_populate_container_bulk(self):
+        barrett = Criteria.get_criteria_dict('GDXHsS00004', 'Barrett')
+        jostins = Criteria.get_criteria_dict('GDXHsS00021', 'Jostins L', {'linkdata': 'pval', 'linkvalue': 2.03e-15})
+        entries = [(['ENSG00000110800', 'ENSG00000134242'], ['T1D', 'MS'], barrett),
+                   (['ENSG00000110800'], ['T1D'], barrett),
+                   (['ENSG00000110800', None], ['CRO'], jostins),
+                   (['ENSG00000163599'], [], jostins)]
+        result_container = Criteria.populate_container_bulk(entries, result_container={})
+        expected_dict = {'ENSG00000110800': {'T1D': [barrett], 'MS': [barrett], 'CRO': [jostins]},
+                         'ENSG00000134242': {'T1D': [barrett], 'MS': [barrett]}}
+        self.assertEqual(result_container, expected_dict, 'Populated in one pass')
+
+    def test_merge_result_containers(self):
+        result_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None, ['ENSG00000110800'], ['T1D'],
+                                                       result_container={})
+        other_container = Criteria.populate_container('GDXHsS00004', 'Barrett', None,
+                                                      ['ENSG00000110800', 'ENSG00000134242'], ['T1D', 'MS'],
+                                                      result_container={})
+        merged = Criteria.merge_result_containers(result_container, other_container)
+        expected_dict = {'ENSG00000110800': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                             'MS': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]},
+                         'ENSG00000134242': {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}],
+                                             'MS': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]}}
+        self.assertEqual(merged, expected_dict, 'Merged containers without duplicates')
+
     def test_fetch_overlapping_features(self):
         region_index = ElasticSettings.idx('REGION', idx_type='STUDY_HITS')
         (region_idx, region_idx_type) = region_index.split('/')
@@ -68,3 +68,14 @@ class CriteriaManagerTest(TestCase):
         criteria_list = CriteriaManager.process_criterias(feature, criteria=criteria, config=None, show=True)
         self.assertIn('cand_gene_in_study', criteria_list, 'cand_gene_in_study in list')
         self.assertNotIn('is_gene_in_mhc', criteria_list, 'is_gene_in_mhc not in in list')
+
+    def test_get_build_weight(self):
+        config = CriteriaManager.get_criteria_config()
+        self.assertEqual(CriteriaManager.get_build_weight('cand_gene_in_study', config), 1, 'Default build weight')
+        self.assertGreater(CriteriaManager.get_build_weight('rsq_with_index_snp', config),
+                           CriteriaManager.get_build_weight('is_an_index_snp', config), 'rsq built first')
+
+    def test_get_criteria_class(self):
+        from criteria.helper.gene_criteria import GeneCriteria
+        self.assertEqual(CriteriaManager.get_criteria_class('gene'), GeneCriteria, 'Got GeneCriteria')
+        self.assertIsNone(CriteriaManager.get_criteria_class('foo'), 'Unsupported feature')
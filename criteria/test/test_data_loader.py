@@ -0,0 +1,152 @@
+from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+import criteria.helper.data_loader
+from criteria.helper.data_loader import DataLoader
+import threading
+import time
+from unittest import mock
+
+
+class FakeDoc():
+
+    def __init__(self, doc_id, **fields):
+        self._doc_id = doc_id
+        self.__dict__.update(fields)
+
+    def doc_id(self):
+        return self._doc_id
+
+
+class DataLoaderTest(TestCase):
+    '''Test DataLoader'''
+
+    def search(self, docs):
+        ''' Patch Search to return the docs with the requested ids, counting the requests. '''
+        self.requested = []
+
+        def matching(keys):
+            return [doc for doc in docs if doc.doc_id() in keys or getattr(doc, 'id', None) in keys]
+
+        def fake_search(search_query=None, idx=None, size=None):
+            keys = search_query
+            self.requested.append(keys)
+            hits = matching(keys)
+            result = mock.Mock(hits_total=len(hits), docs=hits[:size])
+            return mock.Mock(search=mock.Mock(return_value=result))
+
+        def fake_scan_and_scroll(idx, call_fun=None, query=None):
+            self.requested.append(query)
+            call_fun({'hits': {'hits': matching(query)}})
+
+        return [mock.patch('criteria.helper.data_loader.Search', side_effect=fake_search),
+                mock.patch('criteria.helper.data_loader.ScanAndScroll', scan_and_scroll=fake_scan_and_scroll),
+                mock.patch('criteria.helper.data_loader.Document', side_effect=lambda hit: hit),
+                mock.patch('criteria.helper.data_loader.ElasticQuery', side_effect=lambda query, sources=None: query),
+                mock.patch('criteria.helper.data_loader.Query', ids=lambda ids: ids,
+                           terms=lambda field, values: values),
+                mock.patch('criteria.helper.data_loader.ElasticSettings')]
+
+    def test_prime_and_load(self):
+        docs = [FakeDoc('GDXHsS00004', authors=[{'name': 'Barrett', 'initials': 'JC'}]),
+                FakeDoc('GDXHsS00019', authors=[{'name': 'Eyre', 'initials': 'S'}])]
+        patches = self.search(docs)
+        for patch in patches:
+            patch.start()
+        try:
+            loader = DataLoader('STUDY', 'STUDY', value_fun=lambda doc: getattr(doc, 'authors')[0]['name'])
+            loader.prime(['GDXHsS00004', 'GDXHsS00019', 'GDXHsS99999', None])
+            self.assertEqual(loader.requests, 0, 'Nothing fetched when primed')
+            DataLoader.dispatch_all()
+            self.assertEqual(loader.requests, 1, 'Primed ids fetched together')
+            self.assertEqual(loader.load('GDXHsS00004'), 'Barrett')
+            self.assertIsNone(loader.load('GDXHsS99999'), 'Missing doc')
+            self.assertEqual(loader.load_many(['GDXHsS00019', 'GDXHsS00004']), ['Eyre', 'Barrett'])
+            self.assertEqual(loader.requests, 1, 'Loaded values memoised')
+        finally:
+            for patch in patches:
+                patch.stop()
+            DataLoader.loaders.remove(loader)
+
+    def test_chunks_and_terms(self):
+        docs = [FakeDoc('doc' + str(i), id='rs' + str(i), seqid='1') for i in range(5)]
+        patches = self.search(docs)
+        for patch in patches:
+            patch.start()
+        try:
+            loader = DataLoader('MARKER', 'MARKER', field='id', chunk_size=2,
+                                value_fun=lambda doc: getattr(doc, 'seqid'))
+            self.assertEqual(loader.load_many(['rs' + str(i) for i in range(5)]), ['1'] * 5)
+            self.assertEqual(loader.requests, 3, 'Terms query per chunk')
+        finally:
+            for patch in patches:
+                patch.stop()
+            DataLoader.loaders.remove(loader)
+
+    def test_terms_truncated(self):
+        docs = [FakeDoc('doc' + str(i), id='rs1', seqid='1') for i in range(3)] + [FakeDoc('doc3', id='rs2', seqid='2')]
+        patches = self.search(docs)
+        for patch in patches:
+            patch.start()
+        try:
+            loader = DataLoader('MARKER', 'MARKER', field='id', value_fun=lambda doc: getattr(doc, 'seqid'))
+            self.assertEqual(loader.load_many(['rs1', 'rs2']), ['1', '2'], 'No key lost to the duplicate rs1 docs')
+            self.assertEqual(loader.requests, 2, 'Query scrolled when it has more hits than keys')
+        finally:
+            for patch in patches:
+                patch.stop()
+            DataLoader.loaders.remove(loader)
+
+    def test_marker_id_loaders(self):
+        ''' The marker loaders look up the marker id field, which is in several docs for some markers. '''
+        from criteria.helper.gene_criteria import GeneCriteria
+        from criteria.helper.marker_criteria import MarkerCriteria
+
+        docs = [FakeDoc('rs1_' + str(i), id='rs1', seqid='1', info='exonic') for i in range(5)] + \
+            [FakeDoc('rs' + str(i), id='rs' + str(i), seqid=str(i), info='exonic') for i in range(2, 6)]
+        markers = ['rs' + str(i) for i in range(1, 6)]
+        patches = self.search(docs)
+        for patch in patches:
+            patch.start()
+        try:
+            seqids = MarkerCriteria.marker_seqids.load_many(markers)
+            self.assertEqual(seqids, ['1', '2', '3', '4', '5'], 'No marker seqid lost')
+            with mock.patch.object(GeneCriteria.marker_exonic_genes, 'value_fun',
+                                   lambda doc: [getattr(doc, 'info')]):
+                exonic_genes = GeneCriteria.marker_exonic_genes.load_many(markers)
+            self.assertNotIn(None, exonic_genes, 'No exonic marker lost')
+        finally:
+            for patch in patches:
+                patch.stop()
+            MarkerCriteria.marker_seqids.clear()
+            GeneCriteria.marker_exonic_genes.clear()
+
+    def test_concurrent_fetches(self):
+        ''' Threads fetch different keys at the same time and wait for the keys another thread is fetching. '''
+        docs = [FakeDoc('GDXHsS0000' + str(i), authors=[{'name': 'Author' + str(i)}]) for i in range(4)]
+        patches = self.search(docs)
+        for patch in patches:
+            patch.start()
+        fetching = threading.Barrier(2, timeout=5)
+        fake_search = criteria.helper.data_loader.Search.side_effect
+
+        def slow_search(search_query=None, idx=None, size=None):
+            if 'GDXHsS00003' not in search_query:
+                fetching.wait()
+            return fake_search(search_query=search_query, idx=idx, size=size)
+
+        criteria.helper.data_loader.Search.side_effect = slow_search
+        try:
+            loader = DataLoader('STUDY', 'STUDY', value_fun=lambda doc: getattr(doc, 'authors')[0]['name'])
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                # the first two fetch at the same time (or the barrier times out), the third waits for the first
+                futures = [executor.submit(loader.load_many, keys)
+                           for keys in [['GDXHsS00000', 'GDXHsS00001'], ['GDXHsS00002']]]
+                time.sleep(0.1)
+                futures.append(executor.submit(loader.load, 'GDXHsS00000'))
+                results = [future.result() for future in futures]
+            self.assertEqual(results, [['Author0', 'Author1'], ['Author2'], 'Author0'])
+            self.assertEqual(loader.requests, 2, 'Key being fetched not fetched again')
+        finally:
+            for patch in patches:
+                patch.stop()
+            DataLoader.loaders.remove(loader)
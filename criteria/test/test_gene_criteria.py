@@ -6,6 +6,8 @@ from data_pipeline.utils import IniParser
 from criteria.helper.gene_criteria import GeneCriteria
 from django.test.utils import override_settings
 from elastic.utils import ElasticUtils
+from elastic.search import ElasticQuery, ScanAndScroll
+from elastic.query import Query
 import disease.document
 from pydgin.tests.data.settings_idx import PydginTestSettings
 
@@ -197,6 +199,32 @@ class GeneCriteriaTest(TestCase):
                                                            result_container={})
         self.assertTrue(len(criteria_results_17q) > 20, "Got back results greater than the default size")
 
+        # page handler gives the same result as the hits processed one at a time
+        page_handler = GeneCriteria.get_page_handler('gene_in_region')
+        page_results = page_handler([self.region_doc_full, self.region_doc_17q], 'gene_in_region', config, {})
+        hit_results = GeneCriteria.gene_in_region(self.region_doc_full, config=config, result_container={})
+        hit_results = GeneCriteria.gene_in_region(self.region_doc_17q, config=config, result_container=hit_results)
+        self.assertEqual(page_results, hit_results, 'Got the same results from the page handler')
+
+    @override_settings(ELASTIC=PydginTestSettings.OVERRIDE_SETTINGS)
+    def test_query_filters(self):
+        ''' The query_filters select the study hits the criteria use, with the mapping of the test index. '''
+        config = IniParser().read_ini(MY_INI_FILE)
+        source_idx = GeneCriteria.get_source_idx('cand_gene_in_region', config)
+
+        def scroll(query):
+            hits = []
+            ScanAndScroll.scan_and_scroll(source_idx, query=query,
+                                          call_fun=lambda resp_json: hits.extend(resp_json['hits']['hits']))
+            return hits
+
+        all_hits = scroll(ElasticQuery(Query.match_all(), sources=['status', 'disease_locus']))
+        expected = sorted(hit['_id'] for hit in all_hits if hit['_source'].get('status') == 'N' and
+                          hit['_source'].get('disease_locus', '').lower() != 'tbc')
+        self.assertTrue(len(expected) > 0, 'Study hits the criteria use')
+        filtered = sorted(hit['_id'] for hit in scroll(GeneCriteria.get_elastic_query('cand_gene_in_region', config)))
+        self.assertEqual(filtered, expected, 'Filtered to the study hits the criteria use')
+
     def test_cand_gene_in_study(self):
         config = IniParser().read_ini(MY_INI_FILE)
 
@@ -298,6 +326,16 @@ class GeneCriteriaTest(TestCase):
                                                        'fname': 'rs2476601'}]}}
         self.assertEqual(criteria_results, expected_result, 'Got back expected result')
 
+        # prefetched for the page of hits
+        GeneCriteria.marker_exonic_genes.clear()
+        GeneCriteria.study_authors.clear()
+        GeneCriteria.get_page_handler('exonic_index_snp_in_gene')([self.region_hit], 'exonic_index_snp_in_gene', config, {})
+        self.assertIn('rs2476601', GeneCriteria.marker_exonic_genes.cache)
+        self.assertEqual(GeneCriteria.study_authors.cache, {'GDXHsS00019': 'Eyre S'})
+        criteria_results = GeneCriteria.exonic_index_snp_in_gene(self.region_hit,
+                                                                 config=config, result_container={})
+        self.assertEqual(criteria_results, expected_result, 'Got back expected result from prefetched docs')
+
     def test_tag_feature_to_disease(self):
         ''' Test tag_feature_to_disease. '''
         config = IniParser().read_ini(MY_INI_FILE)
@@ -412,3 +450,12 @@ class GeneCriteriaTest(TestCase):
         self.assertIn(feature_id2, criteria_disease_tags)
         self.assertIn('all', criteria_disease_tags[feature_id1])
         self.assertIn('all', criteria_disease_tags[feature_id2])
+
+    def test_clear_caches(self):
+        GeneCriteria.study_hit_indices['38'] = object()
+        GeneCriteria.hit_region_docs[('hit1',)] = []
+        GeneCriteria.gene_docs.cache['ENSG00000134242'] = None
+        GeneCriteria.clear_caches()
+        self.assertEqual(GeneCriteria.study_hit_indices, {}, 'Study hit index cleared')
+        self.assertEqual(GeneCriteria.hit_region_docs, {}, 'Regions of study hits cleared')
+        self.assertEqual(GeneCriteria.gene_docs.cache, {}, 'Loaded gene docs cleared')
@@ -0,0 +1,80 @@
+from django.test import TestCase
+from criteria.helper.intervals import IntervalIndex, IntervalJoin
+import criteria.helper.intervals
+import random
+from unittest import mock
+
+
+class IntervalIndexTest(TestCase):
+    '''Test IntervalIndex'''
+
+    def test_overlaps(self):
+        interval_index = IntervalIndex()
+        interval_index.add('1', 100, 200, 'a')
+        interval_index.add('1', 150, 1000, 'b')
+        interval_index.add('1', 300, 400, 'c')
+        interval_index.add('2', 100, 200, 'd')
+        interval_index.index()
+
+        self.assertEqual(len(interval_index), 4)
+        self.assertEqual(interval_index.overlaps('1', 180, 190), ['a', 'b'], 'Contained and containing intervals')
+        self.assertEqual(interval_index.overlaps('1', 200, 300), ['a', 'b', 'c'], 'Touching intervals overlap')
+        self.assertEqual(interval_index.overlaps('1', 500, 600), ['b'], 'Long interval found')
+        self.assertEqual(interval_index.overlaps('1', 1, 99), [], 'No overlap')
+        self.assertEqual(interval_index.overlaps(2, 50, 5000), ['d'], 'seqid as an int')
+        self.assertEqual(interval_index.overlaps('X', 1, 5000), [], 'seqid not indexed')
+
+    def test_overlaps_random(self):
+        rand = random.Random(5)
+        intervals = []
+        interval_index = IntervalIndex()
+        for i in range(500):
+            start = rand.randint(1, 100000)
+            end = start + rand.randint(0, 5000)
+            intervals.append((start, end, i))
+            interval_index.add('1', start, end, i)
+        interval_index.index()
+
+        for _j in range(100):
+            start = rand.randint(1, 100000)
+            end = start + rand.randint(0, 2000)
+            expected = sorted(i for (s, e, i) in intervals if s <= end and e >= start)
+            self.assertEqual(sorted(interval_index.overlaps('1', start, end)), expected)
+
+
+class IntervalJoinTest(TestCase):
+    '''Test IntervalJoin'''
+
+    def test_join(self):
+        genes = [('1', 100, 200, 'g1'), ('1', 150, 1000, 'g2'), ('1', 300, 400, 'g3'), ('2', 100, 200, 'g4')]
+        regions = [('1', 180, 190, 'r1'), ('X', 1, 1000, 'r2'), ('1', 200, 300, 'r3'), (2, 1, 99, 'r4'),
+                   ('2', 1, 100, 'r5')]
+        pairs = IntervalJoin(genes).join(regions)
+        self.assertEqual(pairs, [('r1', 'g1'), ('r1', 'g2'), ('r3', 'g1'), ('r3', 'g2'), ('r3', 'g3'),
+                                 ('r5', 'g4')], 'Pairs in query order then target start')
+        self.assertEqual(IntervalJoin(genes).join([]), [])
+
+    def test_join_without_numpy(self):
+        genes = [('1', 100, 200, 'g1'), ('1', 150, 1000, 'g2'), ('2', 100, 200, 'g4')]
+        with mock.patch.object(criteria.helper.intervals, 'np', None):
+            with self.assertLogs('criteria.helper.intervals', level='WARNING') as logs:
+                interval_join = IntervalJoin(genes)
+            self.assertIn('falls back to an IntervalIndex', logs.output[0])
+            self.assertEqual(interval_join.join([('1', 180, 190, 'r1'), ('2', 1, 100, 'r2')]),
+                             [('r1', 'g1'), ('r1', 'g2'), ('r2', 'g4')])
+
+    def test_join_random(self):
+        rand = random.Random(7)
+        targets = []
+        for i in range(1000):
+            start = rand.randint(1, 200000)
+            targets.append((rand.choice(['1', '2', '3']), start, start + rand.randint(0, 10000), i))
+        queries = []
+        for j in range(200):
+            start = rand.randint(1, 200000)
+            queries.append((rand.choice(['1', '2', '4']), start, start + rand.randint(0, 3000), j))
+
+        expected = sorted((qid, tid) for (qseqid, qstart, qend, qid) in queries
+                          for (tseqid, tstart, tend, tid) in targets
+                          if qseqid == tseqid and tstart <= qend and tend >= qstart)
+        self.assertEqual(sorted(IntervalJoin(targets).join(queries)), expected)
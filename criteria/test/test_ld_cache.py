@@ -0,0 +1,83 @@
+from django.test import TestCase
+from criteria.helper.ld_cache import LDCache
+from criteria.helper.ld_client import LDClient
+from criteria.test.test_ld_client import FakeRserve
+import os
+import tempfile
+from unittest import mock
+
+
+class LDCacheTest(TestCase):
+    '''Test LDCache'''
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_get_put(self):
+        partners = [{'marker2': 'rs6679677', 'rsquared': 0.99, 'dprime': 1}]
+        ld_cache = LDCache(self.path, panel_version='1')
+        self.assertIsNone(ld_cache.get('EUR', '1', 'rs2476601', 0.8))
+        ld_cache.put('EUR', '1', 'rs2476601', 0.8, partners)
+        self.assertEqual(ld_cache.get('EUR', '1', 'rs2476601', 0.8), partners)
+        self.assertIsNone(ld_cache.get('EUR', '1', 'rs2476601', 0.9), 'rsq is part of the key')
+        self.assertEqual((ld_cache.hits, ld_cache.misses), (1, 2))
+        self.assertAlmostEqual(ld_cache.hit_ratio(), 1 / 3)
+        ld_cache.close()
+
+        # persisted, and only returned for the same panel version
+        ld_cache = LDCache(self.path, panel_version='1')
+        self.assertEqual(ld_cache.get('EUR', 1, 'rs2476601', 0.8), partners)
+        ld_cache.close()
+        ld_cache = LDCache(self.path, panel_version='2')
+        self.assertIsNone(ld_cache.get('EUR', '1', 'rs2476601', 0.8))
+        ld_cache.close()
+
+    def test_evict(self):
+        ld_cache = LDCache(self.path, max_entries=3)
+        for i in range(5):
+            ld_cache.put('EUR', '1', 'rs' + str(i), 0.8, [])
+        ld_cache.get('EUR', '1', 'rs0', 0.8)
+        ld_cache.evict()
+        cached = [i for i in range(5) if ld_cache.get('EUR', '1', 'rs' + str(i), 0.8) is not None]
+        self.assertEqual(cached, [0, 3, 4], 'Least recently used evicted')
+        ld_cache.close()
+
+    def test_ld_client_cache(self):
+        rserve = FakeRserve()
+        ld_client = LDClient(pool_size=2, connect_fun=rserve.connect, cache=LDCache(self.path))
+        ld = ld_client.ld('EUR', '1', 'rs2476601')
+        self.assertEqual(ld_client.ld('EUR', '1', 'rs2476601'), ld)
+        self.assertIn('error', ld_client.ld('EUR', '1', 'rs0'))
+        self.assertIn('error', ld_client.ld('EUR', '1', 'rs0'), 'Errors not cached')
+        self.assertEqual(ld_client.calls, 3)
+        ld_client.close()
+
+        # warm run
+        ld_client = LDClient(pool_size=2, connect_fun=rserve.connect, cache=LDCache(self.path))
+        self.assertEqual(ld_client.ld_many([('EUR', '1', 'rs2476601')]), [ld])
+        self.assertEqual(ld_client.calls, 0)
+        ld_client.close()
+
+    def test_accessed_batched(self):
+        ld_cache = LDCache(self.path)
+        ld_cache.put('EUR', '1', 'rs0', 0.8, [])
+        with mock.patch.object(LDCache, 'ACCESSED_EVERY', 3):
+            for _i in range(2):
+                ld_cache.get('EUR', '1', 'rs0', 0.8)
+            accessed = ld_cache.conn.execute('SELECT accessed FROM ld').fetchone()[0]
+            self.assertEqual(accessed, 1, 'Access times of hits not written per hit')
+            ld_cache.get('EUR', '1', 'rs0', 0.8)
+            accessed = ld_cache.conn.execute('SELECT accessed FROM ld').fetchone()[0]
+            self.assertEqual(accessed, 4, 'Access times written in a batch')
+        ld_cache.get('EUR', '1', 'rs0', 0.8)
+        ld_cache.close()
+
+        ld_cache = LDCache(self.path)
+        self.assertEqual(ld_cache.clock, 5, 'Access times written on close')
+        ld_cache.close()
@@ -0,0 +1,102 @@
+from django.test import TestCase
+from criteria.helper.ld_client import LDClient
+import json
+import threading
+import time
+
+
+class FakeRserve():
+    ''' Stand-in for an Rserve server, counting the connections opened and the ld_run calls. '''
+
+    def __init__(self, fail_calls=0):
+        self.lock = threading.Lock()
+        self.connections = []
+        self.fail_calls = fail_calls
+        self.max_active = 0
+        self.active = 0
+
+    def connect(self, host=None, port=None):
+        conn = FakeConnection(self)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+
+class FakeConnection():
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+        self.r = self
+
+    def ld_run(self, dataset, seqid, marker, dprime=0, rsq=0.8):
+        server = self.server
+        with server.lock:
+            if server.fail_calls > 0:
+                server.fail_calls -= 1
+                raise EOFError('connection lost')
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(0.01)
+        with server.lock:
+            server.active -= 1
+        if marker == 'rs0':
+            return json.dumps({'error': 'marker not found'})
+        return json.dumps({'ld': [{'marker2': marker + '_ld', 'R.squared': rsq, 'D.prime': dprime}]})
+
+    def close(self):
+        self.closed = True
+
+
+class LDClientTest(TestCase):
+    '''Test LDClient against a fake Rserve'''
+
+    def test_ld(self):
+        rserve = FakeRserve()
+        ld_client = LDClient(host='localhost', port=6311, pool_size=2, connect_fun=rserve.connect)
+        ld = ld_client.ld('EUR', '1', 'rs2476601', rsq=0.8)
+        self.assertEqual(ld, {'ld': [{'marker2': 'rs2476601_ld', 'rsquared': 0.8, 'dprime': 0}]})
+        self.assertIn('error', ld_client.ld('EUR', '1', 'rs0'))
+        self.assertEqual(len(rserve.connections), 1, 'Connection reused')
+        ld_client.close()
+        self.assertTrue(rserve.connections[0].closed)
+
+    def test_ld_many(self):
+        rserve = FakeRserve()
+        ld_client = LDClient(host='localhost', port=6311, pool_size=3, connect_fun=rserve.connect)
+        ld_args = [('EUR', '1', 'rs' + str(i)) for i in range(1, 31)]
+        lds = ld_client.ld_many(ld_args)
+        self.assertEqual([ld['ld'][0]['marker2'] for ld in lds], [marker + '_ld' for (_d, _s, marker) in ld_args],
+                         'Results in the order requested')
+        self.assertLessEqual(len(rserve.connections), 3, 'No more than pool_size connections')
+        self.assertGreater(rserve.max_active, 1, 'Calls run concurrently')
+        self.assertEqual(ld_client.calls, 30)
+
+    def test_retry(self):
+        rserve = FakeRserve(fail_calls=1)
+        ld_client = LDClient(host='localhost', port=6311, pool_size=1, connect_fun=rserve.connect)
+        ld = ld_client.ld('EUR', '1', 'rs2476601')
+        self.assertIn('ld', ld)
+        self.assertEqual(len(rserve.connections), 2, 'Failed connection replaced')
+        self.assertTrue(rserve.connections[0].closed)
+
+    def test_close_connections(self):
+        from criteria.helper.marker_criteria import MarkerCriteria
+        import os
+
+        rserve = FakeRserve()
+        ld_client = LDClient(host='localhost', port=6311, pool_size=1, connect_fun=rserve.connect)
+        ld_client.ld('EUR', '1', 'rs2476601')
+        (MarkerCriteria.ld_client, MarkerCriteria.ld_client_pid) = (ld_client, os.getpid())
+        MarkerCriteria.close_connections()
+        self.assertTrue(rserve.connections[0].closed, 'Pooled connection closed')
+        self.assertIsNone(MarkerCriteria.ld_client, 'New client made by the next build')
+
+        # a client inherited from the parent process is not closed
+        rserve = FakeRserve()
+        ld_client = LDClient(host='localhost', port=6311, pool_size=1, connect_fun=rserve.connect)
+        ld_client.ld('EUR', '1', 'rs2476601')
+        (MarkerCriteria.ld_client, MarkerCriteria.ld_client_pid) = (ld_client, os.getpid() + 1)
+        MarkerCriteria.close_connections()
+        self.assertFalse(rserve.connections[0].closed, 'Parent connection left open')
+        self.assertIsNone(MarkerCriteria.ld_client)
@@ -199,6 +199,11 @@ class MarkerCriteriaTest(TestCase):
         p_val_to_compare = float(criteria_results_fnotes['linkvalue'])
         self.assertTrue(p_val_to_compare < gw_sig_p, 'p val less than gwas significant pvalue')
 
+        # _meta of the index types fetched once for the index
+        self.assertIn(self.ic_stats1['_index'], MarkerCriteria.meta_idxs)
+        (disease, _dil_study_id) = MarkerCriteria.get_idx_type_meta(self.ic_stats1['_index'], self.ic_stats1['_type'])
+        self.assertEqual(disease, 'UC')
+
     @override_settings(ELASTIC=PydginTestSettings.OVERRIDE_SETTINGS)
     def test_get_disease_tags(self):
         config = IniParser().read_ini(MY_INI_FILE)
@@ -105,6 +105,22 @@ class RegionCriteriaTest(TestCase):
 
         self.assertEqual(criteria_results, expected_dict, 'Got result dict for is_region_for_disease as expected')
 
+    def test_prefetch_is_region_for_disease(self):
+
+        config = IniParser().read_ini(MY_INI_FILE)
+        RegionCriteria.disease_locus_docs.clear()
+        RegionCriteria.study_hit_docs.clear()
+        RegionCriteria.get_page_handler('is_region_for_disease')([self.region_region1], 'is_region_for_disease', config, {})
+
+        disease_loci = self.region_region1['_source']['disease_loci']
+        self.assertEqual(set(disease_loci), set(RegionCriteria.disease_locus_docs.cache.keys()),
+                         'Disease loci of the page fetched')
+        self.assertTrue(len(RegionCriteria.study_hit_docs.cache) >= len(disease_loci), 'Study hits fetched')
+
+        criteria_results = RegionCriteria.is_region_for_disease(self.region_region1, config=config,
+                                                                result_container={})
+        self.assertEqual(len(criteria_results['1p36.32_002']), 7, 'Got result dict from the prefetched docs')
+
     def test_is_region_in_mhc(self):
 
         config = IniParser().read_ini(MY_INI_FILE)
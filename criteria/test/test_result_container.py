@@ -0,0 +1,98 @@
+from django.test import TestCase
+from criteria.helper.result_container import SpillingResultContainer, CriteriaList, ColumnarResultContainer
+import json
+import os
+import pickle
+
+
+class SpillingResultContainerTest(TestCase):
+    '''Test SpillingResultContainer'''
+
+    def populate(self, result_container, entries):
+        for (feature_id, disease, criteria_dict) in entries:
+            criteria_list = result_container.setdefault(feature_id, {}).setdefault(disease, [])
+            if criteria_dict not in criteria_list:
+                criteria_list.append(criteria_dict)
+            if isinstance(result_container, SpillingResultContainer):
+                result_container.check_budget()
+
+    def test_feature_items(self):
+        entries = [('rs2476601', 'CRO', {'fid': 'rs6679677', 'fname': 'rs6679677',
+                                         'fnotes': {'linkdata': 'rsq', 'linkvalue': 0.97}}),
+                   ('rs11904361', 'CRO', {'fid': 'rs10495903', 'fname': 'rs10495903'}),
+                   ('rs6725688', 'CRO', {'fid': 'rs10495903', 'fname': 'rs10495903'}),
+                   ('rs2476601', 'T1D', {'fid': 'rs6679677', 'fname': 'rs6679677'}),
+                   ('rs2476601', 'CRO', {'fid': 'rs6679677', 'fname': 'rs6679677',
+                                         'fnotes': {'linkdata': 'rsq', 'linkvalue': 0.97}}),
+                   ('rs2476601', 'CRO', {'fid': 'rs10495903', 'fname': 'rs10495903'})]
+
+        expected = {}
+        self.populate(expected, entries)
+
+        result_container = SpillingResultContainer(max_features=1)
+        self.populate(result_container, entries)
+        self.assertTrue(len(result_container.run_files) > 0, 'Spilled to run files')
+        run_files = list(result_container.run_files)
+
+        feature_items = list(result_container.feature_items())
+        self.assertEqual(dict(feature_items), expected, 'Same result as building in memory')
+        self.assertEqual([feature_id for feature_id, _row in feature_items], sorted(expected.keys()),
+                         'Features merged in sorted order')
+        self.assertEqual(list(dict(feature_items)['rs2476601'].keys()), ['CRO', 'T1D'], 'Disease order kept')
+        for run_file in run_files:
+            self.assertFalse(os.path.exists(run_file), 'Run files removed')
+
+    def test_no_spill(self):
+        result_container = SpillingResultContainer(max_features=10)
+        self.populate(result_container, [('ENSG00000110800', 'T1D', {'fid': 'GDXHsS00004', 'fname': 'Barrett'})])
+        self.assertEqual(result_container.run_files, [], 'Nothing spilled')
+        self.assertEqual(list(result_container.feature_items()),
+                         [('ENSG00000110800', {'T1D': [{'fid': 'GDXHsS00004', 'fname': 'Barrett'}]})])
+
+
+class CriteriaListTest(TestCase):
+    '''Test CriteriaList'''
+
+    def test_add(self):
+        criteria_list = CriteriaList([{'fid': 'GDXHsS00004', 'fname': 'Barrett'}])
+        self.assertFalse(criteria_list.add({'fname': 'Barrett', 'fid': 'GDXHsS00004'}), 'Duplicate not added')
+        self.assertTrue(criteria_list.add({'fid': 'GDXHsS00004', 'fname': 'Barrett',
+                                           'fnotes': {'linkdata': 'rsq', 'linkvalue': 0.97}}), 'fnotes differ')
+        self.assertFalse(criteria_list.add({'fid': 'GDXHsS00004', 'fname': 'Barrett',
+                                            'fnotes': {'linkvalue': 0.97, 'linkdata': 'rsq'}}), 'Duplicate fnotes')
+        expected = [{'fid': 'GDXHsS00004', 'fname': 'Barrett'},
+                    {'fid': 'GDXHsS00004', 'fname': 'Barrett', 'fnotes': {'linkdata': 'rsq', 'linkvalue': 0.97}}]
+        self.assertEqual(criteria_list, expected, 'Equal to a plain list in insertion order')
+        self.assertEqual(json.loads(json.dumps(criteria_list)), expected, 'Serialised as a plain list')
+
+        unpickled = pickle.loads(pickle.dumps(criteria_list))
+        self.assertFalse(unpickled.add({'fid': 'GDXHsS00004', 'fname': 'Barrett'}), 'Key index pickled')
+
+
+class ColumnarResultContainerTest(TestCase):
+    '''Test ColumnarResultContainer'''
+
+    def test_feature_items(self):
+        barrett = {'fid': 'GDXHsS00004', 'fname': 'Barrett'}
+        jostins = {'fid': 'GDXHsS00021', 'fname': 'Jostins L', 'fnotes': {'linkdata': 'pval', 'linkvalue': 2.03e-15}}
+        result_container = ColumnarResultContainer()
+        result_container.add(['ENSG00000110800', 'ENSG00000134242'], ['T1D', 'MS'], barrett)
+        result_container.add(['ENSG00000110800'], ['CRO', 'T1D'], dict(jostins))
+        result_container.add(['ENSG00000110800'], ['T1D'], dict(barrett))
+        result_container.add(['ENSG00000163599', None], [], barrett)
+
+        self.assertEqual(len(result_container), 2, 'Two features')
+        self.assertEqual(len(result_container.criteria_dicts), 2, 'Criteria dicts stored once')
+        expected = [('ENSG00000110800', {'T1D': [barrett, jostins], 'MS': [barrett], 'CRO': [jostins]}),
+                    ('ENSG00000134242', {'T1D': [barrett], 'MS': [barrett]})]
+        feature_items = list(result_container.feature_items())
+        self.assertEqual(feature_items, expected, 'Rows as built by the dict container')
+        self.assertEqual(list(feature_items[0][1].keys()), ['T1D', 'MS', 'CRO'], 'Disease order kept')
+
+    def test_many_entries(self):
+        result_container = ColumnarResultContainer()
+        for i in range(100):
+            result_container.add(['rs2476601'], ['T1D'], {'fid': 'rs' + str(i), 'fname': 'rs' + str(i)})
+            result_container.add(['rs2476601'], ['T1D'], {'fid': 'rs' + str(i), 'fname': 'rs' + str(i)})
+        (_feature_id, row) = next(result_container.feature_items())
+        self.assertEqual(len(row['T1D']), 100, 'No duplicates')
@@ -75,3 +75,8 @@ class StudyCriteriaTest(TestCase):
 
         expected_dict = {'GDXHsS00005': {'RA': [{'fid': 'RA', 'fname': 'RA'}], 'T1D': [{'fid': 'T1D', 'fname': 'T1D'}]}}
         self.assertEqual(criteria_results, expected_dict, 'Got result dict for study_for_disease as expected')
+
+        page_handler = StudyCriteria.get_page_handler('study_for_disease')
+        self.assertEqual(page_handler, StudyCriteria.study_for_disease_page, 'Page handler of study_for_disease')
+        criteria_results = page_handler([self.study_doc_full], 'study_for_disease', config, {})
+        self.assertEqual(criteria_results, expected_dict, 'Got result dict from the page handler')
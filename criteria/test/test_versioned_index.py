@@ -0,0 +1,94 @@
+from django.test import TestCase
+from unittest import mock
+import json
+from criteria.helper.versioned_index import VersionedIndex
+
+
+class VersionedIndexTest(TestCase):
+    '''Test VersionedIndex'''
+
+    def setUp(self):
+        self.config = {'DEFAULT': {'CRITERIA_IDX_GENE': 'pydgin_imb_criteria_gene', 'versioned_index': 'true',
+                                   'keep_versions': '2'},
+                       'cand_gene_in_study': {}, 'gene_in_region': {}}
+
+    def test_get_old_versions(self):
+        alias = 'pydgin_imb_criteria_gene'
+        idx_names = ['pydgin_imb_criteria_gene_20160101000000', 'pydgin_imb_criteria_gene_20160201000000',
+                     'pydgin_imb_criteria_gene_20160301000000', 'pydgin_imb_criteria_marker_20160101000000',
+                     'pydgin_imb_criteria_gene_old']
+        live_idx = 'pydgin_imb_criteria_gene_20160301000000'
+
+        self.assertEqual(VersionedIndex.get_old_versions(alias, idx_names, live_idx, 2),
+                         ['pydgin_imb_criteria_gene_20160101000000'], 'Live and previous versions kept')
+        self.assertEqual(VersionedIndex.get_old_versions(alias, idx_names, live_idx, 1),
+                         ['pydgin_imb_criteria_gene_20160101000000', 'pydgin_imb_criteria_gene_20160201000000'],
+                         'Only the live version kept')
+        self.assertEqual(VersionedIndex.get_old_versions(alias, idx_names, live_idx, 5), [], 'All versions kept')
+
+    def test_switch_alias(self):
+        with mock.patch('criteria.helper.versioned_index.Search') as search, \
+                mock.patch('criteria.helper.versioned_index.ElasticSettings'):
+            search.elastic_request.return_value = mock.Mock(status_code=200)
+            VersionedIndex.switch_alias('idx', 'idx_20160101000000', 'idx_20160201000000')
+            actions = json.loads(search.elastic_request.call_args[1]['data'])['actions']
+        self.assertEqual(actions, [{"remove": {"index": "idx_20160101000000", "alias": "idx"}},
+                                   {"add": {"index": "idx_20160201000000", "alias": "idx"}}],
+                         'Alias moved in one request')
+
+    def test_start_build(self):
+        with mock.patch.object(VersionedIndex, 'get_live_idx', return_value='pydgin_imb_criteria_gene_2016'), \
+                mock.patch.object(VersionedIndex, 'get_idx_types',
+                                  return_value=['cand_gene_in_study', 'gene_in_region', 'old_criteria']), \
+                mock.patch.object(VersionedIndex, 'copy_idx_types') as copy_idx_types:
+            (alias, live_idx, version_idx) = VersionedIndex.start_build('gene', ['gene_in_region'], self.config)
+
+            self.assertEqual(alias, 'pydgin_imb_criteria_gene')
+            self.assertEqual(live_idx, 'pydgin_imb_criteria_gene_2016')
+            self.assertTrue(version_idx.startswith(alias + '_'), 'New version of the index')
+            self.assertEqual(self.config['DEFAULT']['CRITERIA_IDX_GENE'], version_idx, 'Built in to the new version')
+            copy_idx_types.assert_called_once_with(live_idx, version_idx, ['cand_gene_in_study'], feature='gene',
+                                                   config=self.config)
+
+    def test_start_build_unversioned(self):
+        alias = 'pydgin_imb_criteria_gene'
+        with mock.patch.object(VersionedIndex, 'get_live_idx', return_value=alias), \
+                mock.patch.object(VersionedIndex, 'get_idx_types', return_value=['cand_gene_in_study']), \
+                mock.patch.object(VersionedIndex, 'copy_idx_types') as copy_idx_types:
+            self.assertRaises(RuntimeError, VersionedIndex.start_build, 'gene', ['gene_in_region'], self.config)
+            self.assertFalse(copy_idx_types.called, 'Nothing copied without replace_unversioned')
+            self.assertEqual(self.config['DEFAULT']['CRITERIA_IDX_GENE'], alias)
+
+            self.config['DEFAULT']['replace_unversioned'] = 'true'
+            (_alias, live_idx, version_idx) = VersionedIndex.start_build('gene', ['gene_in_region'], self.config)
+            self.assertEqual(live_idx, alias)
+            copy_idx_types.assert_called_once_with(alias, version_idx, ['cand_gene_in_study'], feature='gene',
+                                                   config=self.config)
+
+    def test_switch_alias_unversioned(self):
+        with mock.patch('criteria.helper.versioned_index.Search') as search, \
+                mock.patch('criteria.helper.versioned_index.ElasticSettings'), \
+                mock.patch.object(VersionedIndex, 'get_idx_types', return_value=['cand_gene_in_study']), \
+                mock.patch.object(VersionedIndex, 'delete_idx') as delete_idx, \
+                mock.patch.object(VersionedIndex, 'get_live_idx', return_value='idx_20160101000000'):
+            search.elastic_request.return_value = mock.Mock(status_code=200)
+            VersionedIndex.switch_alias('idx', 'idx', 'idx_20160101000000')
+            delete_idx.assert_called_once_with('idx')
+            actions = json.loads(search.elastic_request.call_args[1]['data'])['actions']
+            self.assertEqual(actions, [{"add": {"index": "idx_20160101000000", "alias": "idx"}}])
+
+            VersionedIndex.get_live_idx.return_value = None
+            search.elastic_request.return_value = mock.Mock(status_code=200, content=b'{}')
+            self.assertRaises(RuntimeError, VersionedIndex.switch_alias, 'idx', 'idx', 'idx_20160101000000')
+
+    def test_copy_idx_types_count(self):
+        with mock.patch('criteria.helper.versioned_index.Criteria'), \
+                mock.patch('criteria.helper.versioned_index.BulkLoader'), \
+                mock.patch('criteria.helper.versioned_index.BulkEncoder'), \
+                mock.patch('criteria.helper.versioned_index.ScanAndScroll'), \
+                mock.patch('criteria.helper.versioned_index.ElasticQuery'), \
+                mock.patch('criteria.helper.versioned_index.Query'), \
+                mock.patch('criteria.helper.versioned_index.Search'), \
+                mock.patch.object(VersionedIndex, 'get_count', side_effect=lambda idx, idx_type: len(idx)):
+            VersionedIndex.copy_idx_types('idx_1', 'idx_2', ['cand_gene_in_study'])
+            self.assertRaises(RuntimeError, VersionedIndex.copy_idx_types, 'idx_10', 'idx_2', ['cand_gene_in_study'])
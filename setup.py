@@ -15,6 +15,7 @@ setup(
     url='http://github.com/D-I-L/django-criteria',
     description='A Django app to provide build and manage criteria indexes',
     install_requires=["requests>=2.7.0", "Django>=1.8.4,<1.9"],
+    extras_require={"numpy": ["numpy>=1.9"]},
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',